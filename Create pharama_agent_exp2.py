@@ -1,38 +1,99 @@
-from google import genai
-from google.genai.types import Part, Tool, GenerateContentConfig, GoogleSearch
-from google.colab import files
+import asyncio
 import concurrent.futures
+import queue
+import threading
 import time
-import nest_asyncio
 import re
 import difflib
 from collections import defaultdict
+from medicine_catalog import CATALOG_INDEX, lookup_medicine, find_catalog_matches, normalize_name
+from hedging import HedgedCaller
+from model_cascade import CascadeStats, needs_escalation, majority_name, normalize_with_tuned_model
+from tracing import tracer
+from grounding import extract_grounding_sources, filter_and_rank_sources, format_sources
+from dosage_parser import parse_dosage, select_dosage, describe_dosage
+from single_flight import SingleFlight
+from gemini_client import get_client, is_quota_error
+from prescription_sources import load_prescription
 
-# Apply nest_asyncio to allow nested event loops (needed for Colab)
-nest_asyncio.apply()
-
-# Initialize the client
-API_KEY = "api key"  # Replace with your actual API key
-client = genai.Client(api_key=API_KEY)
+# The google-genai client is process-wide and created on first use (see gemini_client.py);
+# nothing from google.* is imported at module level so worker processes start quickly
 model_id = "gemini-2.0-flash"
 
-# Configure Google Search Tool
-google_search_tool = Tool(
-    google_search=GoogleSearch()
-)
+# Model cascade: with CASCADE_MODE the interpretation passes and verification run on the fast
+# model first, and only positions with low confidence or cross-pass disagreement are re-run on
+# the escalation model. Without it every stage uses model_id.
+CASCADE_MODE = False  # Opt-in: when on, most calls move from model_id to gemini-2.0-flash-lite
+STAGE_MODELS = {
+    "interpretation": "gemini-2.0-flash-lite",
+    "verification": "gemini-2.0-flash-lite",
+    "escalation": "gemini-2.0-flash",
+    "final": "gemini-2.0-flash",
+}
+ESCALATION_CONFIDENCE = 70  # Escalate when the best confidence for a position is below this
+ESCALATION_AGREEMENT = 0.6  # ... or when fewer than this share of passes agree on the name
+ESCALATION_PASSES = 2
+cascade_stats = CascadeStats()
+
+# Streaming mode (opt-in): interpretation passes use generate_content_stream and every completed
+# "N. Name: XX%" line is passed on to catalog lookup and verification while the passes are still running.
+# Streamed passes are not hedged (only the stage deadline applies), and the interpretation checkpoint
+# is saved together with verification, so a crash during verification repeats the interpretation.
+STREAMING_MODE = False
+
+# Tuned-model normalization: with a tuned model id (e.g. "tunedModels/medicine-recognition-1234"),
+# all raw names of a prescription are mapped to catalog brands in one batched request to the tuned
+# model (one request per name if it fails the batch probe, see model_cascade.py), and only the
+# positions it cannot map confidently go on to escalation and verification.
+# Like CONSTRAINED_MODE it needs every position first, so it takes precedence over STREAMING_MODE.
+TUNED_MODEL_ID = None
+
+# Catalog-constrained mode: after a cheap first read, the top-k closest catalog brands for every
+# position are retrieved in one batched n-gram lookup (catalog_index.py, needs numpy) and the image
+# is re-read once with them as a choice list. Positions settled there skip per-medicine verification.
+# Takes precedence over STREAMING_MODE, since the choice lists need every position first.
+CONSTRAINED_MODE = False
+CONSTRAINED_FIRST_PASSES = 2
+CONSTRAINED_TOP_K = 5
+
+def stage_model(stage):
+    return STAGE_MODELS[stage] if CASCADE_MODE else model_id
+
+# Hedged requests with per-stage deadlines: a duplicate call is fired once a call is slower
+# than the stage's p95 latency (at most 10% of calls are hedged)
+interpretation_hedger = HedgedCaller("interpretation", deadline=60.0, hedge_percentile=95, max_hedge_rate=0.1)
+verification_hedger = HedgedCaller("verification", deadline=45.0, hedge_percentile=95, max_hedge_rate=0.1)
+
+# Concurrent verifications of the same normalized input (across prescriptions) share one in-flight call
+verification_flight = SingleFlight("verification")
+
+# Run the non-streaming verification stage on asyncio (client.aio) instead of the thread pool
+ASYNC_VERIFICATION = False
+
+# Configure Google Search Tool (opt-in fallback for names missing from the local catalog)
+google_search_tool = {"google_search": {}}
+USE_GOOGLE_SEARCH_FALLBACK = False
+
+# Local catalog lookup tool (resolved in-process through automatic function calling)
+catalog_tools = [lookup_medicine]
 
-# Upload the image file
-print("Please upload the prescription image:")
-uploaded = files.upload()
+# Function to get the catalog matches for a name, reusing lookups already done (normalized name -> matches)
+def catalog_matches(name, catalog_hits=None):
+    key = normalize_name(name)
+    if catalog_hits is not None and key in catalog_hits:
+        return catalog_hits[key]
+    return find_catalog_matches(name)
 
-# Get the first uploaded file
-file_name = list(uploaded.keys())[0]
-file_content = uploaded[file_name]
+# Function to pick the verification tools: local catalog by default, Google Search only
+# when enabled and none of the interpretations resolve against the catalog
+def select_verification_tools(names, catalog_hits=None):
+    if USE_GOOGLE_SEARCH_FALLBACK and not any(catalog_matches(name, catalog_hits) for name in names):
+        return [google_search_tool]
+    return catalog_tools
 
-image = Part.from_bytes(
-    data=file_content, 
-    mime_type="image/jpeg"
-)
+# Function to wrap prescription image bytes for the model
+def load_image(file_content, mime_type="image/jpeg"):
+    return {"inline_data": {"data": file_content, "mime_type": mime_type}}
 
 # Create prompt for medicine identification (initial passes)
 initial_prompt = """
@@ -50,22 +111,27 @@ Medicine name should be in a list like:
 """
 
 # Function to make a single API call for interpretation
-def generate_interpretation(temperature):
-    response = client.models.generate_content(
-        model=model_id,
+def generate_interpretation(image, temperature, model=None):
+    response = interpretation_hedger.call(
+        get_client().models.generate_content,
+        model=model or stage_model("interpretation"),
         contents=[initial_prompt, image],
-        config=GenerateContentConfig(temperature=temperature),
+        config={"temperature": temperature, "http_options": interpretation_hedger.http_options()},
     )
     # Run final analysis
     return response.text
 
 # Run all interpretations in parallel using ThreadPoolExecutor
-def run_parallel_interpretations(num_passes=5):
+@tracer.traced("interpretations")
+def run_parallel_interpretations(image, num_passes=5, model=None):
     temperatures = [0.7 + (i * 0.2) for i in range(num_passes)]
     
     with concurrent.futures.ThreadPoolExecutor(max_workers=num_passes) as executor:
         # Submit all tasks to the executor
-        future_to_temp = {executor.submit(generate_interpretation, temp): temp for temp in temperatures}
+        future_to_temp = {
+            executor.submit(tracer.wrap(generate_interpretation, "interpretation_pass", temperature=temp), image, temp, model): temp
+            for temp in temperatures
+        }
         
         # Collect results as they complete
         results = []
@@ -76,13 +142,41 @@ def run_parallel_interpretations(num_passes=5):
                 print(f"Completed interpretation with temperature {temp:.1f}")
                 results.append((temp, result))
             except Exception as e:
+                if is_quota_error(e):
+                    raise
                 print(f"Error processing temperature {temp}: {e}")
         
     # Sort results by temperature to maintain order
     results.sort()
     return [r[1] for r in results]
 
+# Function to parse one "N. Medicine Name: XX% dosage" line (None for any other line)
+def parse_medicine_line(line):
+    # Try to extract medicine name and confidence
+    match = re.search(r'^\d+\.\s+(.*?):\s*(\d+)%', line)
+    if not match:
+        return None
+    medicine_name = match.group(1).strip()
+    confidence = int(match.group(2))
+    
+    # Check for dosage info after the confidence percentage
+    dosage_match = re.search(r'\d+%(.*?)$', line)
+    dosage = dosage_match.group(1).strip() if dosage_match else ""
+    
+    # Extract position number
+    position_match = re.search(r'^(\d+)\.', line)
+    position = int(position_match.group(1)) if position_match else 0
+    
+    return {
+        "name": medicine_name,
+        "confidence": confidence,
+        "dosage": dosage,
+        "dosage_info": parse_dosage(dosage),
+        "position": position
+    }
+
 # Function to extract a list of possible medicine names from all interpretations
+@tracer.traced("parse")
 def extract_medicine_candidates(interpretations):
     medicine_candidates = []
     
@@ -90,26 +184,9 @@ def extract_medicine_candidates(interpretations):
         # Look for lines that match the pattern "Medicine Name: XX%" 
         lines = interpretation.strip().split('\n')
         for line in lines:
-            # Try to extract medicine name and confidence
-            match = re.search(r'^\d+\.\s+(.*?):\s*(\d+)%', line)
-            if match:
-                medicine_name = match.group(1).strip()
-                confidence = int(match.group(2))
-                
-                # Check for dosage info after the confidence percentage
-                dosage_match = re.search(r'\d+%(.*?)$', line)
-                dosage = dosage_match.group(1).strip() if dosage_match else ""
-                
-                # Extract position number
-                position_match = re.search(r'^(\d+)\.', line)
-                position = int(position_match.group(1)) if position_match else 0
-                
-                medicine_candidates.append({
-                    "name": medicine_name,
-                    "confidence": confidence,
-                    "dosage": dosage,
-                    "position": position
-                })
+            candidate = parse_medicine_line(line)
+            if candidate:
+                medicine_candidates.append(candidate)
     
     return medicine_candidates
 
@@ -139,73 +216,394 @@ def group_similar_medicines(medicine_candidates):
     
     return formatted_groups
 
-# Function to verify grouped medicines using Google Search
-def verify_medicine_groups(medicine_groups):
-    verification_prompts = []
-    
-    for position, group_text, group in medicine_groups:
-        # Create a prompt for this group
-        prompt = f"""
+# Function to re-run uncertain positions on the stronger model (cascade mode only)
+@tracer.traced("escalation")
+def escalate_uncertain_positions(image, medicine_groups, num_passes):
+    if not CASCADE_MODE:
+        return medicine_groups, set()
+    
+    cascade_stats.record("positions", len(medicine_groups))
+    uncertain = {
+        position for position, _, group in medicine_groups
+        if needs_escalation(group, num_passes, ESCALATION_CONFIDENCE, ESCALATION_AGREEMENT)
+    }
+    
+    if not uncertain:
+        return medicine_groups, uncertain
+    
+    print(f"Escalating positions {sorted(uncertain)} to {STAGE_MODELS['escalation']}...")
+    cascade_stats.record("escalated_positions", len(uncertain))
+    strong_interpretations = run_parallel_interpretations(image, ESCALATION_PASSES, model=STAGE_MODELS["escalation"])
+    strong_candidates = [
+        candidate for candidate in extract_medicine_candidates(strong_interpretations)
+        if candidate["position"] in uncertain
+    ]
+    
+    # Replace the cheap interpretations of escalated positions the strong model returned
+    replaced = {candidate["position"] for candidate in strong_candidates}
+    kept = [med for position, _, group in medicine_groups if position not in replaced for med in group]
+    return group_similar_medicines(kept + strong_candidates), uncertain
+
+# Prompt for the constrained pass; {CHOICES} lists the candidate brands per position
+constrained_prompt = """
+This image contains a handwritten prescription. An earlier reading found the medicines below; for each
+numbered position, the listed names are real Bangladeshi brands that are spelled closest to what was read.
+
+{CHOICES}
+
+Look at the handwriting again and, for each position, choose the brand that is actually written.
+If none of the listed brands matches, write "none" as the name.
+Format each line as "N. Medicine Name: [confidence]% [dosage as written]", keeping the same numbering.
+"""
+
+# Function to retrieve the top-k catalog brands for every position in one batched lookup
+def retrieve_position_candidates(medicine_groups, k=CONSTRAINED_TOP_K):
+    # numpy is only needed in constrained mode, so the index is imported on first use
+    from catalog_index import get_catalog_index
+
+    queries = [(position, med["name"]) for position, _, group in medicine_groups for med in group]
+    matches = get_catalog_index().top_k([name for _, name in queries], k)
+
+    # Merge the matches of every interpretation at a position, keeping each brand's best score
+    scores = defaultdict(dict)
+    for (position, _), brand_scores in zip(queries, matches):
+        for brand, score in brand_scores:
+            scores[position][brand] = max(score, scores[position].get(brand, 0.0))
+    return {
+        position: [brand for brand, _ in sorted(brands.items(), key=lambda x: -x[1])[:k]]
+        for position, brands in scores.items()
+    }
+
+# Function to re-read the prescription once with the catalog candidates as a constrained choice list.
+# Returns position -> candidate for the positions where the model picked one of the listed brands.
+@tracer.traced("constrained_pass")
+def run_constrained_interpretation(image, medicine_groups):
+    choices = retrieve_position_candidates(medicine_groups)
+    if not choices:
+        return {}
+    choice_text = "\n".join(f"{position}. {' | '.join(brands)}" for position, brands in sorted(choices.items()))
+
+    try:
+        response = interpretation_hedger.call(
+            get_client().models.generate_content,
+            model=stage_model("interpretation"),
+            contents=[constrained_prompt.replace("{CHOICES}", choice_text), image],
+            config={"temperature": 0.2, "http_options": interpretation_hedger.http_options()},
+        )
+    except Exception as e:
+        if is_quota_error(e):
+            raise
+        # Every position then goes through the normal escalation and verification path
+        print(f"Error in constrained pass: {e}")
+        return {}
+
+    resolved = {}
+    for line in (response.text or "").split('\n'):
+        candidate = parse_medicine_line(line)
+        if not candidate:
+            continue
+        listed = {normalize_name(brand): brand for brand in choices.get(candidate["position"], [])}
+        brand = listed.get(normalize_name(candidate["name"]))
+        if brand:
+            resolved[candidate["position"]] = dict(candidate, name=brand)
+    print(f"Constrained pass resolved {len(resolved)} of {len(medicine_groups)} positions")
+    return resolved
+
+# Function to normalize every position with the tuned model (batched where supported). A position is
+# settled when its majority name maps to a catalog brand and no other reading maps to a different one.
+# Returns position -> mapped fields (genericName, brandName, dosageType).
+@tracer.traced("tuned_normalization")
+def normalize_positions_with_tuned_model(medicine_groups):
+    names = [med["name"] for _, _, group in medicine_groups for med in group]
+    try:
+        mapped = normalize_with_tuned_model(get_client(), TUNED_MODEL_ID, names, stats=cascade_stats)
+    except Exception as e:
+        if is_quota_error(e):
+            raise
+        print(f"Error normalizing with {TUNED_MODEL_ID}: {e}")
+        return {}
+    
+    resolved = {}
+    for position, _, group in medicine_groups:
+        majority = majority_name(group)
+        brands = {normalize_name(mapped[med["name"]]["brandName"]) for med in group if med["name"] in mapped}
+        if majority in mapped and len(brands) == 1:
+            resolved[position] = mapped[majority]
+    cascade_stats.record("resolved_by_tuned_model", len(resolved))
+    print(f"Tuned model resolved {len(resolved)} of {len(medicine_groups)} positions")
+    return resolved
+
+# Function to build the coalescing key for a verification: normalized candidate names, tools and model
+def verification_key(names, tools, model):
+    tool_kind = "catalog" if tools is catalog_tools else "search"
+    return tuple(sorted({normalize_name(name) for name in names})), tool_kind, model
+
+# Function to build the verification request for one position: (position, prompt, tools, model, key)
+# With catalog_hits (from the streaming lookups) the matches found so far are included in the prompt.
+def build_verification_prompt(position, group_text, group, escalated=False, catalog_hits=None):
+    prompt = f"""
         I have multiple interpretations of a medicine name from a handwritten prescription (position #{position}):
         
         {group_text}
         
         Please analyze these interpretations and determine the most likely correct medicine name.
-        Focus on medicines available in Bangladesh and check pharmaceutical websites like MedEx or Arogga.
+        Focus on medicines available in Bangladesh. Use the lookup_medicine tool to check the interpretations
+        against the Bangladeshi medicine catalog (if it is not available, check websites like MedEx or Arogga).
         
-        Respond with:
-        1. The correct medicine name (most likely actual medicine in Bangladesh)
-        2. The dosage information if available
-        3. Links to where this medicine can be found on Bangladeshi websites
-        4. Brief description of what this medicine is used for
+        Respond briefly with only the correct medicine name (most likely actual medicine in Bangladesh).
         
         Important: Do not invent medicine names. If none of the interpretations match real medicines in Bangladesh,
         choose the closest match or indicate that you cannot find a match.
         """
-        verification_prompts.append((position, prompt))
+    if catalog_hits is not None:
+        brands = {
+            CATALOG_INDEX[key][0]["brandName"]: score
+            for med in group for key, score in catalog_matches(med['name'], catalog_hits)
+        }
+        if brands:
+            prompt += "Catalog entries closest to these interpretations (similarity): " + ", ".join(
+                f"{brand} ({score:.2f})" for brand, score in sorted(brands.items(), key=lambda x: -x[1])
+            ) + "\n"
+    tools = select_verification_tools([med['name'] for med in group], catalog_hits)
+    if escalated:
+        model = STAGE_MODELS["escalation"]
+        cascade_stats.record("escalated_verifications")
+    else:
+        model = stage_model("verification")
+    return position, prompt, tools, model, verification_key([med['name'] for med in group], tools, model)
+
+def verification_config(tools):
+    return {
+        "tools": tools,
+        "response_modalities": ["TEXT"],
+        "temperature": 0.2,
+        "http_options": verification_hedger.http_options(),
+    }
+
+# Function to run one verification call; sources come from the grounding metadata, not the answer text
+def verify_prompt(p):
+    def call():
+        response = verification_hedger.call(
+            get_client().models.generate_content,
+            model=p[3],
+            contents=p[1],
+            config=verification_config(p[2]),
+        )
+        return response.text, filter_and_rank_sources(extract_grounding_sources(response))
+    
+    text, sources = verification_flight.do(p[4], call)
+    return p[0], text, sources
+
+# Asyncio version of verify_prompt (not hedged; coalesces with thread-pool callers of the same key)
+async def verify_prompt_async(p):
+    async def call():
+        response = await get_client().aio.models.generate_content(
+            model=p[3],
+            contents=p[1],
+            config=verification_config(p[2]),
+        )
+        return response.text, filter_and_rank_sources(extract_grounding_sources(response))
+    
+    text, sources = await verification_flight.do_async(p[4], call)
+    return p[0], text, sources
+
+# Function to verify grouped medicines against the local catalog (Google Search as fallback)
+@tracer.traced("verification")
+def verify_medicine_groups(medicine_groups, escalated_positions=()):
+    verification_prompts = [
+        build_verification_prompt(position, group_text, group, position in escalated_positions)
+        for position, group_text, group in medicine_groups
+    ]
     
     # Process verification in parallel
     verification_results = []
     
     with concurrent.futures.ThreadPoolExecutor(max_workers=min(6, len(verification_prompts))) as executor:
         future_to_position = {
-            executor.submit(
-                lambda p: (p[0], client.models.generate_content(
-                    model=model_id,
-                    contents=p[1],
-                    config=GenerateContentConfig(
-                        tools=[google_search_tool],
-                        response_modalities=["TEXT"],
-                        temperature=0.2,
-                    )
-                ).text),
-                prompt
-            ): prompt for prompt in verification_prompts
+            executor.submit(tracer.wrap(verify_prompt, "verify_position", position=prompt[0]), prompt): prompt
+            for prompt in verification_prompts
         }
         
         for future in concurrent.futures.as_completed(future_to_position):
             prompt = future_to_position[future]
             try:
-                position, result = future.result()
-                verification_results.append((position, result))
+                position, result, sources = future.result()
+                verification_results.append((position, result, sources))
                 print(f"Verified medicine at position {position}")
             except Exception as e:
+                if is_quota_error(e):
+                    raise
                 print(f"Error verifying medicine at position {prompt[0]}: {e}")
-                verification_results.append((prompt[0], f"Error: {str(e)}"))
+                verification_results.append((prompt[0], f"Error: {str(e)}", []))
     
     # Sort by position
     verification_results.sort(key=lambda x: x[0])
     return verification_results
 
+# Asyncio version of verify_medicine_groups
+@tracer.traced("verification")
+def verify_medicine_groups_async(medicine_groups, escalated_positions=()):
+    verification_prompts = [
+        build_verification_prompt(position, group_text, group, position in escalated_positions)
+        for position, group_text, group in medicine_groups
+    ]
+    
+    async def run_all():
+        return await asyncio.gather(*(verify_prompt_async(p) for p in verification_prompts), return_exceptions=True)
+    
+    # nest_asyncio lets this run inside Colab's already running event loop
+    import nest_asyncio
+    nest_asyncio.apply()
+    
+    verification_results = []
+    for prompt, result in zip(verification_prompts, asyncio.run(run_all())):
+        if isinstance(result, Exception):
+            if is_quota_error(result):
+                raise result
+            print(f"Error verifying medicine at position {prompt[0]}: {result}")
+            verification_results.append((prompt[0], f"Error: {str(result)}", []))
+        else:
+            print(f"Verified medicine at position {prompt[0]}")
+            verification_results.append(result)
+    
+    verification_results.sort(key=lambda x: x[0])
+    return verification_results
+
+# Function to stream one interpretation pass, calling on_medicine for each medicine line as soon as it is complete.
+# The stream stops early once `stop` is set, and the request is bounded by the interpretation deadline.
+def stream_interpretation(image, temperature, on_medicine, model=None, stop=None):
+    text = ""
+    pending_line = ""
+    for chunk in get_client().models.generate_content_stream(
+        model=model or stage_model("interpretation"),
+        contents=[initial_prompt, image],
+        config={"temperature": temperature, "http_options": interpretation_hedger.http_options()},
+    ):
+        if stop is not None and stop.is_set():
+            return text
+        if not chunk.text:
+            continue
+        text += chunk.text
+        *lines, pending_line = (pending_line + chunk.text).split('\n')
+        for line in lines:
+            candidate = parse_medicine_line(line)
+            if candidate:
+                on_medicine(candidate)
+    
+    # The last line may not end with a newline
+    candidate = parse_medicine_line(pending_line)
+    if candidate:
+        on_medicine(candidate)
+    return text
+
+# Function to run the interpretation passes in streaming mode. Each medicine line is looked up in the
+# catalog as it arrives, and a position is sent to verification as soon as every pass has either moved
+# past it or finished, so verification overlaps with the passes that are still streaming.
+# Streamed calls are not hedged, so the interpretation stage deadline is applied here instead: passes
+# still running when it expires are dropped and the prescription goes on with the lines already received.
+@tracer.traced("streaming_pipeline")
+def run_streaming_pipeline(image, num_passes=5):
+    temperatures = [0.7 + (i * 0.2) for i in range(num_passes)]
+    events = queue.Queue()
+    stop = threading.Event()
+    start_time = time.time()
+    deadline = time.monotonic() + interpretation_hedger.deadline
+    
+    quota_errors = []
+    
+    def run_pass(pass_index, temperature):
+        text = None
+        try:
+            text = stream_interpretation(image, temperature, lambda c: events.put(("medicine", pass_index, c)), stop=stop)
+            print(f"Completed interpretation with temperature {temperature:.1f}")
+        except Exception as e:
+            if is_quota_error(e):
+                quota_errors.append(e)
+                stop.set()
+            print(f"Error processing temperature {temperature}: {e}")
+        finally:
+            events.put(("done", pass_index, text))
+    
+    position_candidates = defaultdict(list)
+    last_position = {i: 0 for i in range(num_passes)}
+    finished = set()
+    interpretations = {}
+    catalog_hits = {}
+    submitted = set()
+    future_to_position = {}
+    verification_results = []
+    
+    # Not used as a context manager: leaving it would wait for dropped passes to finish
+    pass_executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_passes)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as verify_executor:
+        for i, temp in enumerate(temperatures):
+            pass_executor.submit(tracer.wrap(run_pass, "interpretation_pass", temperature=temp), i, temp)
+        
+        while len(finished) < num_passes:
+            try:
+                kind, pass_index, payload = events.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                stragglers = sorted(set(range(num_passes)) - finished)
+                print(f"Interpretation deadline of {interpretation_hedger.deadline:.0f}s exceeded, dropping passes {stragglers}")
+                stop.set()
+                finished.update(stragglers)
+                kind = None
+            if kind == "medicine":
+                position_candidates[payload["position"]].append(payload)
+                last_position[pass_index] = max(last_position[pass_index], payload["position"])
+                # Catalog lookup as soon as the line arrives (cached per normalized name)
+                key = normalize_name(payload["name"])
+                if key not in catalog_hits:
+                    catalog_hits[key] = find_catalog_matches(payload["name"])
+            elif kind == "done" and pass_index not in finished:
+                finished.add(pass_index)
+                if payload is not None:
+                    interpretations[pass_index] = payload
+            
+            # Send every position that no pass can add to anymore to verification
+            for position in sorted(position_candidates):
+                if position in submitted:
+                    continue
+                if not all(i in finished or last_position[i] > position for i in range(num_passes)):
+                    continue
+                submitted.add(position)
+                _, group_text, group = group_similar_medicines(position_candidates[position])[0]
+                escalated = CASCADE_MODE and needs_escalation(group, num_passes, ESCALATION_CONFIDENCE, ESCALATION_AGREEMENT)
+                p = build_verification_prompt(position, group_text, group, escalated, catalog_hits)
+                future_to_position[verify_executor.submit(tracer.wrap(verify_prompt, "verify_position", position=position), p)] = position
+        
+        pass_executor.shutdown(wait=False)
+        if quota_errors:
+            raise quota_errors[0]
+        print(f"All interpretation passes completed in {time.time() - start_time:.2f} seconds")
+        
+        for future in concurrent.futures.as_completed(future_to_position):
+            position = future_to_position[future]
+            try:
+                verification_results.append(future.result())
+                if len(verification_results) == 1:
+                    print(f"First verified medicine after {time.time() - start_time:.2f} seconds")
+                print(f"Verified medicine at position {position}")
+            except Exception as e:
+                if is_quota_error(e):
+                    raise
+                print(f"Error verifying medicine at position {position}: {e}")
+                verification_results.append((position, f"Error: {str(e)}", []))
+    
+    medicine_groups = group_similar_medicines([c for group in position_candidates.values() for c in group])
+    verification_results.sort(key=lambda x: x[0])
+    return [interpretations[i] for i in sorted(interpretations)], medicine_groups, verification_results
+
 # Function to process final results and format the output
-def format_final_results(verification_results):
+@tracer.traced("final")
+def format_final_results(verification_results, medicine_groups=()):
     final_prompt = """
     You are a medical prescription expert specializing in Bangladeshi medicines. 
     I will provide you with verification results for medicines from a prescription.
     
     For each medicine, create a clean, formatted entry with:
     1. The medicine name (exactly as it should be written, based on the verification)
-    2. The dosage information
+    2. The dosage information (copy dosages marked "parsed" exactly; only interpret the ones marked "not parsed")
     3. Any instructions for taking the medicine
     
     Format your response as:
@@ -228,77 +626,175 @@ def format_final_results(verification_results):
     {VERIFICATION_RESULTS}
     """
     
+    # Dosages come from the local parser; the model only sees raw text for the ones it could not parse
+    dosages = {position: select_dosage(group) for position, _, group in medicine_groups}
+    
     # Format the verification results for the prompt
     formatted_results = ""
-    for i, (position, result) in enumerate(verification_results, 1):
+    for i, (position, result, _) in enumerate(verification_results, 1):
         formatted_results += f"\n--- Medicine Position {position} ---\n"
         formatted_results += result + "\n"
+        if position in dosages:
+            formatted_results += f"Dosage: {describe_dosage(dosages[position])}\n"
         formatted_results += "-" * 40 + "\n"
     
     final_prompt = final_prompt.replace("{VERIFICATION_RESULTS}", formatted_results)
     
     # Get final analysis
-    response = client.models.generate_content(
-        model=model_id,
+    response = get_client().models.generate_content(
+        model=stage_model("final"),
         contents=final_prompt,
-        config=GenerateContentConfig(
-            tools=[google_search_tool],
-            response_modalities=["TEXT"],
-            temperature=0.1,  # Very low temperature for consistent output
-        )
+        config={
+            "tools": catalog_tools,
+            "response_modalities": ["TEXT"],
+            "temperature": 0.1,  # Very low temperature for consistent output
+        }
     )
     
     return response.text
 
+# Pipeline stages, in order. Each stage result is JSON-serializable so it can be checkpointed.
+PIPELINE_STAGES = ["interpretation", "verification", "final"]
+
+# Raised instead of reporting a stage done when its output is not usable, so it is never checkpointed
+class StageFailed(RuntimeError):
+    pass
+
+# Function to reject stage results that only carry errors: no interpretation pass succeeded, or a
+# position could not be verified (verification errors are kept as "Error: ..." result texts)
+def check_stage_result(stage, result):
+    if stage == "interpretation" and not result:
+        raise StageFailed("all interpretation passes failed")
+    if stage == "verification":
+        failed = [position for position, text, _ in result["verification_results"] if text.startswith("Error: ")]
+        if failed:
+            raise StageFailed(f"verification failed for positions {failed}")
+
+# Function to run the pipeline for one prescription, skipping stages already in `completed`
+# (stage -> result) and calling on_stage_done(stage, result) as each remaining stage finishes.
+# A failed stage raises StageFailed (quota errors are re-raised as they are) before on_stage_done.
+def run_pipeline(image, completed=None, on_stage_done=None):
+    completed = dict(completed or {})
+    
+    def stage_done(stage, result):
+        check_stage_result(stage, result)
+        completed[stage] = result
+        if on_stage_done:
+            on_stage_done(stage, result)
+    
+    if "verification" not in completed:
+        if STREAMING_MODE and not (CONSTRAINED_MODE or TUNED_MODEL_ID) and "interpretation" not in completed:
+            # Stream the passes; positions are verified while later lines are still being generated
+            interpretations, medicine_groups, verification_results = run_streaming_pipeline(image)
+            stage_done("interpretation", interpretations)
+        else:
+            if "interpretation" not in completed:
+                # Execute all interpretation passes concurrently (a cheap first read in constrained mode)
+                num_passes = CONSTRAINED_FIRST_PASSES if CONSTRAINED_MODE else 5
+                stage_done("interpretation", run_parallel_interpretations(image, num_passes))
+            interpretations = completed["interpretation"]
+            
+            # Extract medicine candidates and group them by position
+            medicine_candidates = extract_medicine_candidates(interpretations)
+            medicine_groups = group_similar_medicines(medicine_candidates)
+            
+            # Settle what the constrained re-read can; only the remaining positions go on below
+            settled_results = []
+            unresolved_groups = medicine_groups
+            if CONSTRAINED_MODE:
+                resolved = run_constrained_interpretation(image, medicine_groups)
+                settled_results = [
+                    (position, f"Correct medicine name: {candidate['name']} (chosen from catalog candidates)", [])
+                    for position, candidate in resolved.items()
+                ]
+                unresolved_groups = [g for g in medicine_groups if g[0] not in resolved]
+            
+            # Map the remaining names with the tuned model
+            if TUNED_MODEL_ID and unresolved_groups:
+                normalized = normalize_positions_with_tuned_model(unresolved_groups)
+                settled_results += [
+                    (position, f"Correct medicine name: {fields['brandName']} "
+                               f"({fields.get('genericName', 'generic unknown')}, {fields.get('dosageType', 'form unknown')}) "
+                               f"- mapped by the tuned model", [])
+                    for position, fields in normalized.items()
+                ]
+                unresolved_groups = [g for g in unresolved_groups if g[0] not in normalized]
+            
+            # Re-run low-confidence / disagreeing positions on the stronger model
+            unresolved_groups, escalated_positions = escalate_uncertain_positions(image, unresolved_groups, len(interpretations))
+            settled = {position for position, _, _ in settled_results}
+            medicine_groups = sorted([g for g in medicine_groups if g[0] in settled] + unresolved_groups, key=lambda g: g[0])
+            
+            # Verify each remaining medicine group against the catalog
+            verification_results = []
+            if unresolved_groups:
+                if ASYNC_VERIFICATION:
+                    verification_results = verify_medicine_groups_async(unresolved_groups, escalated_positions)
+                else:
+                    verification_results = verify_medicine_groups(unresolved_groups, escalated_positions)
+            verification_results = sorted(settled_results + verification_results, key=lambda x: x[0])
+        stage_done("verification", {"medicine_groups": medicine_groups, "verification_results": verification_results})
+    
+    if "final" not in completed:
+        verification = completed["verification"]
+        stage_done("final", format_final_results(verification["verification_results"], verification["medicine_groups"]))
+    
+    return completed
+
 # Main execution flow
-def main():
+@tracer.traced("prescription")
+def main(image):
     print(f"Running multiple interpretation passes in parallel...")
     start_time = time.time()
+    stage_start = [start_time]
     
-    # Execute all interpretation passes concurrently
-    all_interpretations = run_parallel_interpretations()
-    
-    interpretation_time = time.time()
-    print(f"All interpretation passes completed in {interpretation_time - start_time:.2f} seconds")
-    
-    # Print all interpretations
-    for i, interpretation in enumerate(all_interpretations, 1):
-        print(f"\n=== PASS {i} INTERPRETATION ===")
-        print(interpretation)
-        print("-" * 60)
-    
-    # Extract medicine candidates from all interpretations
-    medicine_candidates = extract_medicine_candidates(all_interpretations)
-    print(f"\nExtracted {len(medicine_candidates)} medicine candidates")
-    
-    # Group similar medicine names
-    medicine_groups = group_similar_medicines(medicine_candidates)
-    print(f"\nGrouped into {len(medicine_groups)} medicine positions")
-    
-    # Print the groups
-    print("\n=== MEDICINE INTERPRETATION GROUPS ===")
-    for position, group_text, _ in medicine_groups:
-        print(group_text)
-    print("-" * 60)
-    
-    # Verify each medicine group with Google Search
-    print("\nVerifying medicine groups with Google Search (this may take some time)...")
-    verification_results = verify_medicine_groups(medicine_groups)
-    
-    verification_time = time.time()
-    print(f"Medicine verification completed in {verification_time - interpretation_time:.2f} seconds")
-    
-    # Format the final results
-    print("\nGenerating final analysis with verified medicine names...")
-    final_result = format_final_results(verification_results)
+    # Print each stage's output and timing as it completes
+    def report_stage(stage, result):
+        now = time.time()
+        print(f"{stage.capitalize()} stage completed in {now - stage_start[0]:.2f} seconds")
+        stage_start[0] = now
+        
+        if stage == "interpretation":
+            for i, interpretation in enumerate(result, 1):
+                print(f"\n=== PASS {i} INTERPRETATION ===")
+                print(interpretation)
+                print("-" * 60)
+        elif stage == "verification":
+            print("\n=== MEDICINE INTERPRETATION GROUPS ===")
+            for position, group_text, _ in result["medicine_groups"]:
+                print(group_text)
+            print("-" * 60)
+            print("\nGenerating final analysis with verified medicine names...")
+    
+    completed = run_pipeline(image, on_stage_done=report_stage)
+    verification_results = completed["verification"]["verification_results"]
     
     end_time = time.time()
-    print(f"Final analysis completed in {end_time - verification_time:.2f} seconds")
     print(f"Total processing time: {end_time - start_time:.2f} seconds")
+    print(f"Hedging - {interpretation_hedger.report()}")
+    print(f"Hedging - {verification_hedger.report()}")
+    print(f"Coalescing - {verification_flight.report()}")
+    if CASCADE_MODE:
+        print(f"Cascade - {cascade_stats.report()}")
     
     # Print final results
     print("\n=== FINAL PRESCRIPTION MEDICINES ===")
-    print(final_result)
+    print(completed["final"])
+    
+    # Print the grounded sources (only present when the Google Search fallback was used)
+    if any(sources for _, _, sources in verification_results):
+        print("\n=== SOURCES ===")
+        for position, _, sources in verification_results:
+            print(f"Medicine {position}:")
+            print(format_sources(sources))
 
 if __name__ == "__main__":
-    main()
+    import sys
+    
+    # python "Create pharama_agent_exp2.py" [image_path]; without a path the image is uploaded in Colab
+    if len(sys.argv) > 1:
+        file_content, mime_type = load_prescription("path", sys.argv[1])
+    else:
+        file_content, mime_type = load_prescription("colab")
+    main(load_image(file_content, mime_type))
+    tracer.export()
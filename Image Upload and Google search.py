@@ -30,6 +30,7 @@ OUTPUT FORMAT:
 from google import genai
 from google.genai.types import Tool, GenerateContentConfig, GoogleSearch, Image,Part
 from google.colab import files
+from grounding import extract_grounding_sources, filter_and_rank_sources, format_sources
 
 client = genai.Client(api_key="Your API Key")
 model_id = "gemini-2.0-flash"
@@ -67,5 +68,6 @@ response = client.models.generate_content(
 for each in response.candidates[0].content.parts:
     print(each.text)
 
-# To get grounding metadata as web content.
-print(response.text)
+# Sources from the grounding metadata (MedEx / Arogga only, ranked locally)
+print("Sources:")
+print(format_sources(filter_and_rank_sources(extract_grounding_sources(response))))
@@ -0,0 +1,246 @@
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from prescription_sources import load_prescription
+from gemini_client import is_quota_error
+
+# Agent whose run_pipeline() is executed for every prescription
+AGENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Create pharama_agent_exp2.py")
+
+# A claimed prescription whose worker has not reported back within this many seconds is
+# treated as abandoned (crashed process or machine) and can be claimed again
+LEASE_SECONDS = 15 * 60
+MAX_ATTEMPTS = 3
+
+# Cold start budget for a worker: importing the agent must not pull in google.genai, Colab or
+# network setup (the shared client is created on the first request)
+STARTUP_BUDGET_SECONDS = 0.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS work (
+    prescription TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    claimed_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS stage_results (
+    prescription TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    result TEXT NOT NULL,
+    finished_at REAL NOT NULL,
+    PRIMARY KEY (prescription, stage)
+);
+"""
+
+
+# Function to open the shared work-queue database (several processes or machines may use the
+# same file; writes are serialized by SQLite's file lock)
+def connect(state_dir):
+    os.makedirs(state_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(state_dir, "batch_state.sqlite"), timeout=60, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout = 60000")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# Function to read a manifest: one image path per line (blank lines and # comments are skipped)
+def read_manifest(manifest_path):
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base_dir, line) for line in lines if line and not line.startswith("#")]
+
+
+# Function to add manifest entries to the queue; entries already queued keep their progress
+def enqueue(conn, prescriptions):
+    conn.executemany("INSERT OR IGNORE INTO work (prescription) VALUES (?)", [(p,) for p in prescriptions])
+
+
+# Function to claim the next prescription for this worker, or None when the queue is drained
+def claim(conn, worker):
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            """SELECT prescription FROM work
+               WHERE status = 'pending' OR (status = 'running' AND claimed_at < ?)
+               ORDER BY attempts, prescription LIMIT 1""",
+            (now - LEASE_SECONDS,),
+        ).fetchone()
+        if row:
+            conn.execute(
+                "UPDATE work SET status = 'running', worker = ?, claimed_at = ?, attempts = attempts + 1 WHERE prescription = ?",
+                (worker, now, row[0]),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row[0] if row else None
+
+
+# Function to release prescriptions held by worker processes on this machine that no longer exist,
+# so a rerun after a crash resumes them right away instead of waiting for the lease to expire
+def release_dead_workers(conn):
+    host = socket.gethostname()
+    for prescription, worker in conn.execute("SELECT prescription, worker FROM work WHERE status = 'running'").fetchall():
+        worker_host, pid, _ = worker.rsplit(":", 2)
+        if worker_host != host:
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except PermissionError:
+            continue  # the pid exists but belongs to another user's process: treat it as alive
+        except ProcessLookupError:
+            conn.execute("UPDATE work SET status = 'pending' WHERE prescription = ? AND worker = ?", (prescription, worker))
+
+
+def load_completed_stages(conn, prescription):
+    rows = conn.execute("SELECT stage, result FROM stage_results WHERE prescription = ?", (prescription,))
+    return {stage: json.loads(result) for stage, result in rows}
+
+
+def save_stage(conn, prescription, stage, result, worker):
+    conn.execute(
+        "INSERT OR REPLACE INTO stage_results (prescription, stage, result, finished_at) VALUES (?, ?, ?, ?)",
+        (prescription, stage, json.dumps(result), time.time()),
+    )
+    # Renew the lease so long prescriptions are not taken over mid-run
+    conn.execute("UPDATE work SET claimed_at = ? WHERE prescription = ? AND worker = ?", (time.time(), prescription, worker))
+
+
+def finish(conn, prescription, status, error=None):
+    conn.execute("UPDATE work SET status = ?, error = ? WHERE prescription = ?", (status, error, prescription))
+
+
+_agent = None
+
+
+# Function to load the agent once per process. run_batch loads it before forking, so forked
+# workers inherit the already-imported module instead of importing it again.
+def load_agent(agent_path=AGENT_PATH):
+    global _agent
+    if _agent is None:
+        spec = importlib.util.spec_from_file_location("pharma_agent", agent_path)
+        agent = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(agent)
+        _agent = agent
+    return _agent
+
+
+# Function to measure the cold import time of the agent in a fresh interpreter
+def measure_cold_start(agent_path=AGENT_PATH):
+    code = (
+        "import time; start = time.perf_counter(); import batch_runner; "
+        f"batch_runner.load_agent({agent_path!r}); print(time.perf_counter() - start)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+# Worker loop: claim a prescription, run the stages it has not finished yet, checkpoint each stage
+def worker_main(state_dir, worker_index):
+    worker = f"{socket.gethostname()}:{os.getpid()}:{worker_index}"
+    start = time.perf_counter()
+    conn = connect(state_dir)
+    agent = load_agent()
+    startup = time.perf_counter() - start
+    if startup > STARTUP_BUDGET_SECONDS:
+        print(f"[{worker}] Warning: worker startup took {startup:.2f}s (budget {STARTUP_BUDGET_SECONDS}s)")
+
+    while True:
+        prescription = claim(conn, worker)
+        if prescription is None:
+            break
+
+        completed = load_completed_stages(conn, prescription)
+        remaining = [stage for stage in agent.PIPELINE_STAGES if stage not in completed]
+        print(f"[{worker}] {os.path.basename(prescription)}: running {', '.join(remaining)}")
+
+        try:
+            image = agent.load_image(*load_prescription("path", prescription))
+            agent.run_pipeline(
+                image, completed,
+                on_stage_done=lambda stage, result: save_stage(conn, prescription, stage, result, worker),
+            )
+            finish(conn, prescription, "done")
+        except Exception as e:
+            attempts = conn.execute("SELECT attempts FROM work WHERE prescription = ?", (prescription,)).fetchone()[0]
+            finish(conn, prescription, "failed" if attempts >= MAX_ATTEMPTS else "pending", str(e))
+            print(f"[{worker}] Error processing {prescription}: {e}")
+            # The agent re-raises quota errors as soon as they happen, so nothing partial was saved
+            if is_quota_error(e):
+                print(f"[{worker}] API quota exhausted, stopping; rerun later to resume")
+                break
+
+    conn.close()
+
+
+# Function to run a manifest with several worker processes. Rerunning with the same state_dir
+# skips finished prescriptions and resumes partial ones from their last completed stage; other
+# machines can join by running the same command against a shared state_dir.
+def run_batch(manifest_path, state_dir="batch_state", workers=4):
+    conn = connect(state_dir)
+    enqueue(conn, read_manifest(manifest_path))
+    release_dead_workers(conn)
+    conn.close()
+
+    # Prefork: import the agent once in the parent when workers are forked
+    if multiprocessing.get_start_method() == "fork":
+        load_agent()
+
+    processes = [multiprocessing.Process(target=worker_main, args=(state_dir, i)) for i in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    conn = connect(state_dir)
+    summary = dict(conn.execute("SELECT status, COUNT(*) FROM work GROUP BY status").fetchall())
+    conn.close()
+    print(f"Batch summary: {summary}")
+    return summary
+
+
+# Function to collect the final results of finished prescriptions
+def export_results(state_dir="batch_state"):
+    conn = connect(state_dir)
+    rows = conn.execute("SELECT prescription, result FROM stage_results WHERE stage = 'final' ORDER BY prescription")
+    results = {prescription: json.loads(result) for prescription, result in rows}
+    conn.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resumable batch runner for prescription images")
+    parser.add_argument("manifest", nargs="?", help="text file with one prescription image path per line")
+    parser.add_argument("--state-dir", default="batch_state", help="directory holding the shared work queue")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--export", help="write final results of finished prescriptions to this JSON file")
+    parser.add_argument("--measure-startup", action="store_true",
+                        help="measure the agent's cold import time against the startup budget and exit")
+    args = parser.parse_args()
+
+    if args.measure_startup:
+        seconds = measure_cold_start()
+        print(f"Agent cold import: {seconds:.3f}s (budget {STARTUP_BUDGET_SECONDS}s)")
+        sys.exit(0 if seconds <= STARTUP_BUDGET_SECONDS else 1)
+    if not args.manifest:
+        parser.error("manifest is required")
+
+    run_batch(args.manifest, args.state_dir, args.workers)
+    if args.export:
+        with open(args.export, "w", encoding="utf-8") as f:
+            json.dump(export_results(args.state_dir), f, indent=2)
@@ -0,0 +1,91 @@
+from collections import Counter
+
+import numpy as np
+
+try:
+    from scipy import sparse
+except ImportError:  # small catalogs work fine with a dense matrix
+    sparse = None
+
+from medicine_catalog import CATALOG, normalize_name
+
+NGRAM_SIZE = 3
+
+
+# Function to split a name into padded character n-grams ("napa" -> " na", "nap", "apa", "pa ")
+def char_ngrams(text, n=NGRAM_SIZE):
+    padded = f" {normalize_name(text)} "
+    return [padded[i:i + n] for i in range(max(1, len(padded) - n + 1))]
+
+
+# Character n-gram TF-IDF index over the catalog brand names. All queries of a prescription are
+# scored against the whole catalog in a single matrix product.
+class CatalogIndex:
+    def __init__(self, catalog=CATALOG, n=NGRAM_SIZE):
+        self.n = n
+        self.brands = list(dict.fromkeys(entry["brandName"] for entry in catalog))
+        self.vocab = {}
+
+        rows, cols, counts = [], [], []
+        for row, brand in enumerate(self.brands):
+            for gram, count in Counter(char_ngrams(brand, n)).items():
+                rows.append(row)
+                cols.append(self.vocab.setdefault(gram, len(self.vocab)))
+                counts.append(count)
+
+        document_frequency = np.bincount(cols, minlength=len(self.vocab))
+        self.idf = np.log((1 + len(self.brands)) / (1 + document_frequency)) + 1.0
+        self.matrix = self._build_matrix(rows, cols, counts, len(self.brands))
+
+    # Function to build an L2-normalized TF-IDF matrix (sparse when scipy is available)
+    def _build_matrix(self, rows, cols, counts, num_rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        values = np.asarray(counts, dtype=np.float64) * self.idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights=values ** 2, minlength=num_rows))
+        values = values / np.where(norms[rows] > 0, norms[rows], 1.0)
+
+        shape = (num_rows, len(self.vocab))
+        if sparse is not None:
+            return sparse.csr_matrix((values, (rows, cols)), shape=shape)
+        matrix = np.zeros(shape)
+        np.add.at(matrix, (rows, cols), values)
+        return matrix
+
+    # Function to vectorize query names (n-grams missing from the catalog are ignored)
+    def _vectorize(self, names):
+        rows, cols, counts = [], [], []
+        for row, name in enumerate(names):
+            for gram, count in Counter(char_ngrams(name, self.n)).items():
+                col = self.vocab.get(gram)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+                    counts.append(count)
+        return self._build_matrix(rows, cols, counts, len(names))
+
+    # Function to return the k most similar brands for every name, as [(brandName, cosine score)]
+    def top_k(self, names, k=5):
+        if not names:
+            return []
+        scores = self._vectorize(names) @ self.matrix.T
+        scores = scores.toarray() if sparse is not None else np.asarray(scores)
+
+        k = min(k, len(self.brands))
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, columns in enumerate(best):
+            ranked = sorted(columns, key=lambda column: -scores[row, column])
+            results.append([(self.brands[column], float(scores[row, column])) for column in ranked if scores[row, column] > 0])
+        return results
+
+
+_index = None
+
+
+# Function to get the process-wide index (built on first use)
+def get_catalog_index():
+    global _index
+    if _index is None:
+        _index = CatalogIndex()
+    return _index
@@ -0,0 +1,173 @@
+import re
+from collections import Counter
+
+# Frequency abbreviations used on Bangladeshi prescriptions -> (times per day, morning/noon/night doses)
+FREQUENCY_ABBREVIATIONS = {
+    "od": (1, [1, 0, 0]),
+    "qd": (1, [1, 0, 0]),
+    "bd": (2, [1, 0, 1]),
+    "bid": (2, [1, 0, 1]),
+    "tds": (3, [1, 1, 1]),
+    "tid": (3, [1, 1, 1]),
+    "qds": (4, None),
+    "qid": (4, None),
+    "hs": (1, [0, 0, 1]),
+}
+AS_NEEDED = {"sos", "prn"}
+DURATION_UNITS = {"day": 1, "days": 1, "d": 1, "week": 7, "weeks": 7, "wk": 7, "wks": 7, "month": 30, "months": 30, "mo": 30}
+
+# Compiled once at import
+_PATTERN = re.compile(r'(?<![\d.])([\d½¼]+(?:\.\d+)?)\s*[+\-]\s*([\d½¼]+(?:\.\d+)?)\s*[+\-]\s*([\d½¼]+(?:\.\d+)?)(?:\s*[+\-]\s*([\d½¼]+(?:\.\d+)?))?(?![\d.])')
+_ABBREVIATION = re.compile(r'\b(' + "|".join(list(FREQUENCY_ABBREVIATIONS) + list(AS_NEEDED)) + r')\b\.?', re.IGNORECASE)
+_DURATION = re.compile(r'(?:\bx|×|\bfor|\()\s*(\d+)\s*(days?|d|weeks?|wks?|wk|months?|mo)\b', re.IGNORECASE)
+_CONTINUE = re.compile(r'\b(cont(?:inue)?\.?|continued)\b', re.IGNORECASE)
+_BEFORE_MEAL = re.compile(r'\b(before\s+(?:meal|food|eating)s?|a\.?c\.?(?=\s|$|,)|empty\s+stomach)', re.IGNORECASE)
+_AFTER_MEAL = re.compile(r'\b(after\s+(?:meal|food|eating)s?|p\.?c\.?(?=\s|$|,))', re.IGNORECASE)
+_STRENGTH = re.compile(r'(\d+(?:\.\d+)?)\s*(mg|mcg|µg|g|ml|iu|%)(?![a-z])', re.IGNORECASE)
+
+_FRACTIONS = {"½": 0.5, "¼": 0.25}
+_DOSE_VALUE = re.compile(r'(\d+(?:\.\d+)?)?([½¼])?')
+_WORD = re.compile(r'[a-z0-9½¼]+')
+
+# Words that may be left over after all known fields are removed without changing the meaning
+FILLER_WORDS = {"x", "for", "daily", "a", "day", "and", "then", "with", "the", "each",
+                "tab", "tabs", "tablet", "tablets", "cap", "caps", "capsule", "capsules"}
+
+
+# Function to convert one dose value ("1", "0.5", "½", "1½") to a number; raises ValueError otherwise
+def _dose(value):
+    match = _DOSE_VALUE.fullmatch(value)
+    if not match or not any(match.groups()):
+        raise ValueError(f"not a dose: {value!r}")
+    number = float(match.group(1) or 0) + _FRACTIONS.get(match.group(2), 0)
+    return int(number) if number.is_integer() else number
+
+
+# Dates like "12-05-2024" also look like a dose pattern; a real dose has no leading zero and at most two digits
+def _looks_like_dose(value):
+    digits = value.split(".")[0]
+    return len(digits) <= 2 and not (len(digits) > 1 and digits.startswith("0"))
+
+
+def _empty_result(text):
+    return {
+        "raw": text,
+        "pattern": "",
+        "doses": None,
+        "times_per_day": None,
+        "as_needed": False,
+        "duration_days": None,
+        "continue": False,
+        "meal": "",
+        "strength": "",
+        "understood": False,
+    }
+
+
+def _parse_dosage(text):
+    result = _empty_result(text)
+    if not text:
+        return result
+    consumed = []  # spans of the text covered by a recognized field
+
+    pattern = _PATTERN.search(text)
+    values = [value for value in pattern.groups() if value is not None] if pattern else []
+    if pattern and all(_looks_like_dose(value) for value in values):
+        doses = [_dose(value) for value in values]
+        result["pattern"] = "+".join(values)
+        result["doses"] = doses
+        result["times_per_day"] = sum(1 for dose in doses if dose)
+        consumed.append(pattern.span())
+    elif not pattern:
+        abbreviation = _ABBREVIATION.search(text)
+        if abbreviation:
+            consumed.append(abbreviation.span())
+            key = abbreviation.group(1).lower()
+            if key in AS_NEEDED:
+                result["as_needed"] = True
+            else:
+                result["times_per_day"], result["doses"] = FREQUENCY_ABBREVIATIONS[key]
+                result["pattern"] = key.upper()
+
+    duration = _DURATION.search(text)
+    continued = _CONTINUE.search(text)
+    if duration:
+        result["duration_days"] = int(duration.group(1)) * DURATION_UNITS[duration.group(2).lower()]
+        consumed.append(duration.span())
+    elif continued:
+        result["continue"] = True
+        consumed.append(continued.span())
+
+    meal = _BEFORE_MEAL.search(text) or _AFTER_MEAL.search(text)
+    if meal:
+        result["meal"] = "before" if meal.re is _BEFORE_MEAL else "after"
+        consumed.append(meal.span())
+
+    strength = _STRENGTH.search(text)
+    if strength:
+        result["strength"] = f"{strength.group(1)}{strength.group(2).lower()}"
+        consumed.append(strength.span())
+
+    # Whatever no field accounted for must be filler, otherwise the parse is incomplete
+    leftover = list(text)
+    for start, end in consumed:
+        leftover[start:end] = " " * (end - start)
+    unread = [word for word in _WORD.findall("".join(leftover).lower()) if word not in FILLER_WORDS]
+
+    has_frequency = bool(result["pattern"] or result["as_needed"])
+    result["understood"] = has_frequency and not unread
+    return result
+
+
+# Function to parse a dosage string ("1+0+1 x 7 days after meal", "500mg BD") into structured fields.
+# "understood" is True only when a frequency was found and nothing meaningful is left over, so any
+# partly read text is still passed on raw for the LLM to interpret. Never raises.
+def parse_dosage(text):
+    try:
+        return _parse_dosage(text)
+    except (ValueError, KeyError):
+        return _empty_result(text)
+
+
+# Function to parse a batch of dosage strings
+def parse_dosages(texts):
+    return [parse_dosage(text) for text in texts]
+
+
+# Function to format parsed dosage fields as one line for prompts and output
+def format_dosage(info):
+    parts = []
+    if info["pattern"]:
+        parts.append(f"{info['pattern']} ({info['times_per_day']} times daily)")
+    if info["as_needed"]:
+        parts.append("as needed")
+    if info["strength"]:
+        parts.append(info["strength"])
+    if info["meal"]:
+        parts.append(f"{info['meal']} meal")
+    if info["duration_days"]:
+        parts.append(f"for {info['duration_days']} days")
+    elif info["continue"]:
+        parts.append("continue")
+    return ", ".join(parts)
+
+
+# Function to pick one dosage for a group of candidates: the parsed reading most passes agree on,
+# otherwise the first raw dosage text (returned with understood=False)
+def select_dosage(candidates):
+    parsed = [c["dosage_info"] for c in candidates if c.get("dosage_info") and c["dosage_info"]["understood"]]
+    if parsed:
+        votes = Counter(format_dosage(info) for info in parsed)
+        best = votes.most_common(1)[0][0]
+        return next(info for info in parsed if format_dosage(info) == best)
+    return parse_dosage(next((c["dosage"] for c in candidates if c["dosage"]), ""))
+
+
+# Function to describe a dosage for the final prompt: parsed dosages are marked as final so the
+# model only interprets the ones the parser could not understand
+def describe_dosage(info):
+    if info["understood"]:
+        return f"{format_dosage(info)} (parsed - use exactly as given)"
+    if info["raw"]:
+        return f"{info['raw']} (not parsed - interpret this)"
+    return "not written"
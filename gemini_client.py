@@ -0,0 +1,62 @@
+import os
+import threading
+
+API_KEY = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY") or "Your api key"
+
+# HTTP connection pool shared by every call in the process (kept-alive connections skip
+# the TCP/TLS handshake on later requests)
+MAX_CONNECTIONS = 32
+MAX_KEEPALIVE_CONNECTIONS = 16
+KEEPALIVE_EXPIRY_SECONDS = 120
+
+# Upper bound for any single request, including the ones that are not hedged (streaming, final,
+# asyncio). Hedged calls pass their tighter stage deadline per request (HedgedCaller.http_options).
+REQUEST_TIMEOUT_SECONDS = 120
+
+# API errors that mean the quota is used up. Matched on the status of google.genai's APIError
+# (code / status), not on the message text.
+QUOTA_STATUS_CODES = {429}
+QUOTA_STATUSES = {"RESOURCE_EXHAUSTED"}
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+def _build_client(api_key):
+    # google.genai and httpx are imported here, on first use, to keep import of the agent cheap
+    import httpx
+    from google import genai
+    from google.genai import types
+
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+    )
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            timeout=REQUEST_TIMEOUT_SECONDS * 1000,
+            client_args={"limits": limits},
+            async_client_args={"limits": limits},
+        ),
+    )
+
+
+# Function to get the process-wide client. It is built lazily on first use and rebuilt in a
+# forked child, since pooled connections cannot be shared across processes.
+def get_client(api_key=None):
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                _client = _build_client(api_key or API_KEY)
+                _client_pid = pid
+    return _client
+
+
+# Function to tell whether an exception is an API quota error
+def is_quota_error(error):
+    return getattr(error, "code", None) in QUOTA_STATUS_CODES or getattr(error, "status", None) in QUOTA_STATUSES
@@ -0,0 +1,67 @@
+from urllib.parse import urlparse
+
+# Bangladeshi medicine sites, in order of preference
+PREFERRED_DOMAINS = ["medex.com.bd", "arogga.com"]
+
+# Google Search grounding returns redirect URIs; the chunk title then holds the source domain
+_REDIRECT_HOSTS = {"vertexaisearch.cloud.google.com"}
+
+
+def _source_domain(uri, title):
+    host = urlparse(uri).netloc.lower()
+    if not host or host in _REDIRECT_HOSTS:
+        host = (title or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+# Function to turn candidates[0].grounding_metadata into structured source records
+def extract_grounding_sources(response):
+    if not response.candidates:
+        return []
+    metadata = response.candidates[0].grounding_metadata
+    if metadata is None or not metadata.grounding_chunks:
+        return []
+
+    sources = []
+    for chunk in metadata.grounding_chunks:
+        web = chunk.web
+        sources.append({
+            "title": web.title if web else "",
+            "uri": web.uri if web else "",
+            "domain": _source_domain(web.uri, web.title) if web else "",
+            "segments": [],
+            "confidence": 0.0,
+        })
+
+    # Attach the response segments each source supports
+    for support in metadata.grounding_supports or []:
+        scores = support.confidence_scores or []
+        for i, chunk_index in enumerate(support.grounding_chunk_indices or []):
+            if chunk_index >= len(sources):
+                continue
+            source = sources[chunk_index]
+            if support.segment and support.segment.text:
+                source["segments"].append(support.segment.text)
+            if i < len(scores):
+                source["confidence"] = max(source["confidence"], scores[i])
+
+    return sources
+
+
+# Function to keep sources from the preferred domains and rank them locally:
+# preferred domain order first, then how many segments they support, then confidence
+def filter_and_rank_sources(sources, preferred_domains=PREFERRED_DOMAINS):
+    def domain_rank(source):
+        for rank, domain in enumerate(preferred_domains):
+            if source["domain"] == domain or source["domain"].endswith("." + domain):
+                return rank
+        return None
+
+    ranked = [source for source in sources if domain_rank(source) is not None]
+    ranked.sort(key=lambda source: (domain_rank(source), -len(source["segments"]), -source["confidence"]))
+    return ranked
+
+
+# Function to format source records as short lines for printing
+def format_sources(sources):
+    return "\n".join(f"  - {source['domain']}: {source['uri']}" for source in sources) or "  (no sources)"
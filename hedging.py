@@ -0,0 +1,125 @@
+import concurrent.futures
+import threading
+import time
+from collections import deque
+from tracing import tracer
+
+
+# Hedged request runner for one pipeline stage.
+# A call is sent once; if it has not returned after the stage's latency percentile,
+# a duplicate is fired and whichever returns first wins. The number of hedges is capped
+# at max_hedge_rate of all calls, and every call is bounded by the stage deadline.
+# A request that is already running cannot be cancelled from here, so callers must also pass
+# http_options() in the request config: the HTTP timeout then ends losing duplicates and
+# timed-out requests instead of leaving them to hold a worker. Hedges run on their own small
+# pool so they never queue ahead of primary calls.
+class HedgedCaller:
+    def __init__(self, stage, deadline=60.0, hedge_percentile=95, max_hedge_rate=0.1,
+                 initial_hedge_delay=10.0, min_samples=10, max_workers=32, hedge_workers=4):
+        self.stage = stage
+        self.deadline = deadline
+        self.hedge_percentile = hedge_percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.initial_hedge_delay = initial_hedge_delay
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=200)
+        self.stats = {"calls": 0, "hedges_fired": 0, "hedges_won": 0, "deadline_exceeded": 0}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"call-{stage}"
+        )
+        self._hedge_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=hedge_workers, thread_name_prefix=f"hedge-{stage}"
+        )
+
+    # Per-request HTTP options bounding a single request by the stage deadline (timeout is in ms)
+    def http_options(self):
+        return {"timeout": int(self.deadline * 1000)}
+
+    # Function to compute how long to wait before hedging (configured percentile of observed latency)
+    def hedge_delay(self):
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return self.initial_hedge_delay
+            ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        return ordered[index]
+
+    # Function to estimate how long a fresh request needs (median observed latency, 0 before any samples)
+    def typical_latency(self):
+        with self._lock:
+            if not self.latencies:
+                return 0.0
+            ordered = sorted(self.latencies)
+        return ordered[len(ordered) // 2]
+
+    # Reserve a hedge if the stage is still under its hedge budget
+    def _reserve_hedge(self):
+        with self._lock:
+            if self.stats["hedges_fired"] >= self.max_hedge_rate * self.stats["calls"]:
+                return False
+            self.stats["hedges_fired"] += 1
+            return True
+
+    def _timed(self, fn, args, kwargs):
+        start = time.monotonic()
+        result = fn(*args, **kwargs)
+        with self._lock:
+            self.latencies.append(time.monotonic() - start)
+        return result
+
+    # Function to run fn with hedging; raises TimeoutError when the stage deadline passes
+    def call(self, fn, *args, **kwargs):
+        deadline = time.monotonic() + self.deadline
+        with self._lock:
+            self.stats["calls"] += 1
+
+        primary = self._executor.submit(
+            tracer.wrap(self._timed, "model_call", stage=self.stage, attempt="primary"), fn, args, kwargs
+        )
+        hedge = None
+        pending = {primary}
+        error = None
+
+        done, pending = concurrent.futures.wait(pending, timeout=max(0.0, min(self.hedge_delay(), deadline - time.monotonic())))
+        # A hedge is only worth sending if it can still finish before the deadline
+        remaining = deadline - time.monotonic()
+        if not done and remaining > self.typical_latency() and remaining > 0 and self._reserve_hedge():
+            hedge = self._hedge_executor.submit(
+                tracer.wrap(self._timed, "model_call", stage=self.stage, attempt="hedge"), fn, args, kwargs
+            )
+            pending.add(hedge)
+
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    # Take the first successful response. cancel() only stops a request that is
+                    # still queued; one already in flight ends on its own HTTP timeout.
+                    for other in pending:
+                        other.cancel()
+                    if future is hedge:
+                        with self._lock:
+                            self.stats["hedges_won"] += 1
+                    return future.result()
+                error = future.exception()
+
+            remaining = deadline - time.monotonic()
+            if not pending:
+                raise error
+            if remaining <= 0:
+                for other in pending:
+                    other.cancel()
+                with self._lock:
+                    self.stats["deadline_exceeded"] += 1
+                raise TimeoutError(f"{self.stage} call exceeded its {self.deadline:.0f}s deadline")
+
+            done, pending = concurrent.futures.wait(
+                pending, timeout=remaining, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+    # Function to format the hedging metrics for the run summary
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+        return (f"{self.stage}: {stats['calls']} calls, {stats['hedges_fired']} hedges fired, "
+                f"{stats['hedges_won']} hedges won, {stats['deadline_exceeded']} deadlines exceeded")
@@ -0,0 +1,131 @@
+import difflib
+import json
+import os
+import re
+from tracing import tracer
+
+# Path to a full catalog export: a JSON list of {"genericName", "brandName", "dosageType", "strength"}
+# entries ("strength" is optional). The medicine_data list in Fine_tuning.ipynb already has this shape,
+# so a catalog can be built from the notebook with
+#     json.dump(medicine_data, open("medicine_catalog.json", "w"))
+# or from a MedEx/Arogga export. Relative paths are resolved against this module's directory.
+# When the file is missing only the small seed catalog below is available, and most real
+# prescriptions will not be found in it (see USE_GOOGLE_SEARCH_FALLBACK in the agents).
+CATALOG_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.environ.get("MEDICINE_CATALOG_PATH", "medicine_catalog.json"),
+)
+
+# Seed catalog (same format as the fine-tuning dataset in Fine_tuning.ipynb)
+SEED_CATALOG = [
+    {"genericName": "Abacavir + Lamivudine + Zidovudine", "brandName": "Tivizid", "dosageType": "Tablet", "strength": ""},
+    {"genericName": "Abemaciclib", "brandName": "Abeclib", "dosageType": "Tablet", "strength": ""},
+    {"genericName": "Abiraterone Acetate", "brandName": "Abiret", "dosageType": "Tablet", "strength": ""},
+    {"genericName": "Abiraterone Acetate", "brandName": "Zytix", "dosageType": "Tablet", "strength": ""},
+    {"genericName": "Abiraterone Acetate", "brandName": "Zytiga", "dosageType": "Tablet", "strength": ""},
+    {"genericName": "Acalabrutinib", "brandName": "Calcent", "dosageType": "Capsule", "strength": ""},
+    {"genericName": "Acarbose", "brandName": "Acaril", "dosageType": "Tablet", "strength": ""},
+    {"genericName": "Acarbose", "brandName": "Gluco-A", "dosageType": "Tablet", "strength": ""},
+    {"genericName": "Paracetamol", "brandName": "Napa", "dosageType": "Tablet", "strength": "500mg"},
+    {"genericName": "Fusidic Acid", "brandName": "Fusid", "dosageType": "Cream", "strength": "2%"},
+    {"genericName": "Montelukast", "brandName": "Montair", "dosageType": "Tablet", "strength": "10mg"},
+    {"genericName": "Fexofenadine Hydrochloride", "brandName": "Fexofast", "dosageType": "Tablet", "strength": "120mg"},
+    {"genericName": "Albendazole", "brandName": "Alben DS", "dosageType": "Tablet", "strength": "400mg"},
+    {"genericName": "Linagliptin + Metformin Hydrochloride", "brandName": "Linatab", "dosageType": "Tablet", "strength": "2.5mg+500mg"},
+    {"genericName": "Esomeprazole", "brandName": "Progut MUPS", "dosageType": "Tablet", "strength": "20mg"},
+    {"genericName": "Tramadol Hydrochloride", "brandName": "Utramal Retard", "dosageType": "Tablet", "strength": "50mg"},
+    {"genericName": "Carboxymethylcellulose Sodium", "brandName": "Carmelus", "dosageType": "Eye Drop", "strength": ""},
+]
+
+# Dosage form abbreviations used on Bangladeshi prescriptions
+FORM_ALIASES = {
+    "tab": "tablet",
+    "cap": "capsule",
+    "inj": "injection",
+    "syp": "syrup",
+    "susp": "suspension",
+    "drop": "eye drop",
+    "oint": "ointment",
+}
+
+_FORM_PREFIX = re.compile(r'^(tab|cap|inj|syp|susp|oint)\b\.?\s*', re.IGNORECASE)
+_STRENGTH = re.compile(r'\(?\d+(\.\d+)?\s*(mg|mcg|g|ml|%)\)?', re.IGNORECASE)
+
+
+# Function to normalize a medicine name for index lookups ("Tab. Montair 10mg" -> "montair")
+def normalize_name(name):
+    name = _FORM_PREFIX.sub("", name.strip())
+    name = _STRENGTH.sub("", name)
+    return re.sub(r'[^a-z0-9+]+', ' ', name.lower()).strip()
+
+
+def normalize_form(form):
+    form = form.strip().lower().rstrip(".")
+    return FORM_ALIASES.get(form, form)
+
+
+# Function to load the catalog from disk (falls back to the seed catalog)
+def load_catalog(path=CATALOG_PATH):
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    print(f"Warning: medicine catalog {path} not found, using the {len(SEED_CATALOG)}-entry seed catalog. "
+          f"Most medicines will not be found; set MEDICINE_CATALOG_PATH to a full catalog export.")
+    return list(SEED_CATALOG)
+
+
+# Function to build the in-process index: normalized brand name -> catalog entries
+def build_catalog_index(catalog):
+    index = {}
+    for entry in catalog:
+        index.setdefault(normalize_name(entry["brandName"]), []).append(entry)
+    return index
+
+
+CATALOG = load_catalog()
+CATALOG_INDEX = build_catalog_index(CATALOG)
+
+
+# Function to resolve a name against the index (exact match first, then closest spellings)
+def find_catalog_matches(name, max_matches=3, cutoff=0.75):
+    key = normalize_name(name)
+    if key in CATALOG_INDEX:
+        return [(key, 1.0)]
+    close = difflib.get_close_matches(key, CATALOG_INDEX.keys(), n=max_matches, cutoff=cutoff)
+    return [(match, difflib.SequenceMatcher(None, key, match).ratio()) for match in close]
+
+
+def lookup_medicine(name: str, form: str = "", strength: str = "") -> dict:
+    """Look up a medicine in the local Bangladeshi medicine catalog.
+
+    Args:
+        name: Medicine name as read from the prescription (e.g. "Furid" or "Tab. Montair").
+        form: Optional dosage form (e.g. "Tablet", "Cap", "Syrup").
+        strength: Optional strength (e.g. "10mg").
+
+    Returns:
+        A dict with "found" and a list of "matches" (brandName, genericName, dosageType,
+        strength and a similarity score between 0 and 1).
+    """
+    wanted_form = normalize_form(form) if form else ""
+    wanted_strength = strength.replace(" ", "").lower()
+
+    matches = []
+    with tracer.span("catalog_lookup", medicine=name):
+        catalog_matches = find_catalog_matches(name)
+    for key, score in catalog_matches:
+        for entry in CATALOG_INDEX[key]:
+            if wanted_form and normalize_form(entry["dosageType"]) != wanted_form:
+                continue
+            if wanted_strength and entry.get("strength") and \
+                    entry["strength"].replace(" ", "").lower() != wanted_strength:
+                continue
+            matches.append({
+                "brandName": entry["brandName"],
+                "genericName": entry["genericName"],
+                "dosageType": entry["dosageType"],
+                "strength": entry.get("strength", ""),
+                "score": round(score, 2),
+            })
+
+    return {"query": name, "found": bool(matches), "matches": matches}
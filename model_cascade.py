@@ -0,0 +1,142 @@
+import concurrent.futures
+import re
+import threading
+from collections import Counter
+from medicine_catalog import normalize_name, find_catalog_matches
+from gemini_client import is_quota_error
+
+
+# Function to decide whether a group of interpretations should be escalated to a stronger model:
+# either the best confidence is low or the passes disagree on the name
+def needs_escalation(group, num_passes, min_confidence=70, min_agreement=0.6):
+    if not group:
+        return True
+    votes = Counter(normalize_name(med["name"]) for med in group)
+    agreement = votes.most_common(1)[0][1] / max(num_passes, 1)
+    best_confidence = max(med["confidence"] for med in group)
+    return best_confidence < min_confidence or agreement < min_agreement
+
+
+# Function to pick the name most passes agreed on (ties broken by confidence)
+def majority_name(group):
+    votes = Counter(normalize_name(med["name"]) for med in group)
+    best = max(group, key=lambda med: (votes[normalize_name(med["name"])], med["confidence"]))
+    return best["name"]
+
+
+# Function to parse the tuned model output ("genericName: X, brandName: Y, dosageType: Z")
+def parse_tuned_output(text):
+    fields = dict(re.findall(r'(genericName|brandName|dosageType):\s*([^,\n]+)', text))
+    if "brandName" not in fields:
+        return None
+    return {key: value.strip() for key, value in fields.items()}
+
+
+# The tuned model was trained on one name per request (Fine_tuning.ipynb). Before names are batched,
+# these training inputs are sent once as a numbered list; batching is used only if every answer
+# comes back on its own numbered line with the expected brand.
+TUNED_PROBE = {"Tivizid": "Tivizid", "Abeclib Tab": "Abeclib", "Acaril": "Acaril"}
+_batch_support = {}
+_batch_support_lock = threading.Lock()
+_LIST_MARKER = re.compile(r'^\s*(?:\d+[.)]|[-*•])\s*')
+
+
+# Function to send names as one numbered list; returns number -> answer line, or None when the
+# answer has no numbered lines at all (e.g. a single unnumbered line for several names)
+def _tuned_batch_answers(client, tuned_model_id, names):
+    prompt = "\n".join(f"{i}. {name}" for i, name in enumerate(names, 1))
+    response = client.models.generate_content(model=tuned_model_id, contents=prompt)
+    answers = {}
+    for line in (response.text or "").split("\n"):
+        match = re.match(r'\s*(\d+)\.\s*(.*)', line)
+        if match:
+            answers[int(match.group(1))] = match.group(2)
+    return answers or None
+
+
+# Function to send each name in its own request, the input format the model was trained on
+def _tuned_single_answers(client, tuned_model_id, names):
+    def ask(name):
+        return client.models.generate_content(model=tuned_model_id, contents=name).text or ""
+
+    answers = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(names))) as executor:
+        futures = {executor.submit(ask, name): i for i, name in enumerate(names, 1)}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                answers[futures[future]] = future.result()
+            except Exception as e:
+                if is_quota_error(e):
+                    raise
+                print(f"Error mapping {names[futures[future] - 1]} with {tuned_model_id}: {e}")
+    return answers
+
+
+# Function to check once per model whether it answers numbered batches line by line
+def tuned_model_supports_batches(client, tuned_model_id):
+    with _batch_support_lock:
+        if tuned_model_id not in _batch_support:
+            names = list(TUNED_PROBE)
+            try:
+                answers = _tuned_batch_answers(client, tuned_model_id, names) or {}
+            except Exception as e:
+                if is_quota_error(e):
+                    raise
+                print(f"Error probing {tuned_model_id} with a batch: {e}")
+                answers = {}
+            mapped = [parse_tuned_output(answers.get(i, "")) for i in range(1, len(names) + 1)]
+            _batch_support[tuned_model_id] = all(
+                fields and normalize_name(fields["brandName"]) == normalize_name(TUNED_PROBE[name])
+                for name, fields in zip(names, mapped)
+            )
+            if not _batch_support[tuned_model_id]:
+                print(f"{tuned_model_id} does not answer numbered batches; mapping one name per request")
+        return _batch_support[tuned_model_id]
+
+
+# Function to map raw medicine names to catalog brands with the tuned model. Names go in one
+# numbered request when the model passed the batch probe, otherwise (or when a batch answer cannot
+# be parsed) in one request per name. Returns name -> mapped fields, only for names whose brand
+# exists in the catalog with at least min_score similarity.
+def normalize_with_tuned_model(client, tuned_model_id, names, min_score=0.9, stats=None):
+    names = list(dict.fromkeys(names))
+    if not names:
+        return {}
+    # List markers left on a name ("2. Furid") would be confused with the batch numbering
+    inputs = [_LIST_MARKER.sub("", name) or name for name in names]
+
+    answers = None
+    if len(names) > 1 and tuned_model_supports_batches(client, tuned_model_id):
+        answers = _tuned_batch_answers(client, tuned_model_id, inputs)
+        if answers is None:
+            print(f"Could not parse the batched answer from {tuned_model_id}; mapping one name per request")
+            if stats:
+                stats.record("tuned_batch_unparseable")
+    if answers is None:
+        answers = _tuned_single_answers(client, tuned_model_id, inputs)
+
+    normalized = {}
+    for i, name in enumerate(names, 1):
+        mapped = parse_tuned_output(answers.get(i, ""))
+        if not mapped:
+            continue
+        matches = find_catalog_matches(mapped["brandName"])
+        if matches and matches[0][1] >= min_score:
+            normalized[name] = mapped
+    return normalized
+
+
+# Thread-safe escalation counters for the run summary
+class CascadeStats:
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, event, count=1):
+        with self._lock:
+            self.counts[event] += count
+
+    def report(self):
+        with self._lock:
+            counts = dict(self.counts)
+        return ", ".join(f"{event}: {count}" for event, count in counts.items()) or "no escalations"
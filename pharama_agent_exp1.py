@@ -1,36 +1,62 @@
-from google import genai
-from google.genai.types import Part, Tool,GenerateContentConfig,GoogleSearch
-from google.colab import files
 import concurrent.futures
 import time
-import nest_asyncio
 import re
+from medicine_catalog import lookup_medicine, find_catalog_matches, normalize_name
+from hedging import HedgedCaller
+from model_cascade import CascadeStats, needs_escalation, normalize_with_tuned_model
+from tracing import tracer
+from grounding import extract_grounding_sources, filter_and_rank_sources, format_sources
+from dosage_parser import parse_dosage, describe_dosage
+from single_flight import SingleFlight
+from gemini_client import get_client
+from prescription_sources import load_prescription
 
-# Apply nest_asyncio to allow nested event loops (needed for Colab)
-nest_asyncio.apply()
-
-# Initialize the client
-API_KEY = "Your api key"  # Replace with your actual API key
-client = genai.Client(api_key=API_KEY)
+# The google-genai client is process-wide and created on first use (see gemini_client.py)
 model_id = "gemini-2.0-flash"
 
-# Configure Google Search Tool
-google_search_tool = Tool(
-    google_search=GoogleSearch()
-)
+# Model cascade: with CASCADE_MODE the interpretation passes and verification run on the fast
+# model first, and only candidates with low confidence or cross-pass disagreement are verified
+# on the escalation model. Without it every stage uses model_id.
+CASCADE_MODE = False  # Opt-in: when on, most calls move from model_id to gemini-2.0-flash-lite
+STAGE_MODELS = {
+    "interpretation": "gemini-2.0-flash-lite",
+    "verification": "gemini-2.0-flash-lite",
+    "escalation": "gemini-2.0-flash",
+    "final": "gemini-2.0-flash",
+}
+TUNED_MODEL_ID = None  # Optional, e.g. "tunedModels/medicine-recognition-1234": maps names before verification
+ESCALATION_CONFIDENCE = 70  # Escalate when the best confidence for a name is below this
+ESCALATION_AGREEMENT = 0.6  # ... or when fewer than this share of passes produced the name
+cascade_stats = CascadeStats()
+
+def stage_model(stage):
+    return STAGE_MODELS[stage] if CASCADE_MODE else model_id
+
+# Hedged requests with per-stage deadlines: a duplicate call is fired once a call is slower
+# than the stage's p95 latency (at most 10% of calls are hedged)
+interpretation_hedger = HedgedCaller("interpretation", deadline=60.0, hedge_percentile=95, max_hedge_rate=0.1)
+verification_hedger = HedgedCaller("verification", deadline=45.0, hedge_percentile=95, max_hedge_rate=0.1)
+
+# Concurrent verifications of the same normalized name share one in-flight call
+verification_flight = SingleFlight("verification")
 
-# Upload the image file
-print("Please upload the prescription image:")
-uploaded = files.upload()
+# Configure Google Search Tool (opt-in fallback for names missing from the local catalog)
+google_search_tool = {"google_search": {}}
+USE_GOOGLE_SEARCH_FALLBACK = False
 
-# Get the first uploaded file
-file_name = list(uploaded.keys())[0]
-file_content = uploaded[file_name]
+# Local catalog lookup tool (resolved in-process through automatic function calling)
+catalog_tools = [lookup_medicine]
 
-image = Part.from_bytes(
-    data=file_content, 
-    mime_type="image/jpeg"
-)
+# Function to pick the verification tools: local catalog by default, Google Search only
+# when enabled and the name does not resolve against the catalog
+def select_verification_tools(name):
+    if USE_GOOGLE_SEARCH_FALLBACK and not find_catalog_matches(name):
+        return [google_search_tool]
+    return catalog_tools
+
+# Function to wrap prescription image bytes for the model
+def load_image(file_content, mime_type="image/jpeg"):
+    return {"inline_data": {"data": file_content, "mime_type": mime_type}}
 
 # Create prompt for medicine identification (initial passes)
 initial_prompt = """
@@ -47,22 +73,27 @@ Medicine name should be in a list like:
 """
 
 # Function to make a single API call for interpretation
-def generate_interpretation(temperature):
-    response = client.models.generate_content(
-        model=model_id,
+def generate_interpretation(image, temperature):
+    response = interpretation_hedger.call(
+        get_client().models.generate_content,
+        model=stage_model("interpretation"),
         contents=[initial_prompt, image],
-        config=GenerateContentConfig(temperature=temperature),
+        config={"temperature": temperature, "http_options": interpretation_hedger.http_options()},
     )
     # Run final analysis
     return response.text
 
 # Run all interpretations in parallel using ThreadPoolExecutor
-def run_parallel_interpretations(num_passes=5):
+@tracer.traced("interpretations")
+def run_parallel_interpretations(image, num_passes=5):
     temperatures = [1.0 + (i * 0.1) for i in range(num_passes)]
     
     with concurrent.futures.ThreadPoolExecutor(max_workers=num_passes) as executor:
         # Submit all tasks to the executor
-        future_to_temp = {executor.submit(generate_interpretation, temp): temp for temp in temperatures}
+        future_to_temp = {
+            executor.submit(tracer.wrap(generate_interpretation, "interpretation_pass", temperature=temp), image, temp): temp
+            for temp in temperatures
+        }
         
         # Collect results as they complete
         results = []
@@ -80,6 +111,7 @@ def run_parallel_interpretations(num_passes=5):
     return [r[1] for r in results]
 
 # Function to extract a list of possible medicine names from all interpretations
+@tracer.traced("parse")
 def extract_medicine_candidates(interpretations):
     medicine_candidates = []
     
@@ -100,58 +132,71 @@ def extract_medicine_candidates(interpretations):
                 medicine_candidates.append({
                     "name": medicine_name,
                     "confidence": confidence,
-                    "dosage": dosage
+                    "dosage": dosage,
+                    "dosage_info": parse_dosage(dosage)
                 })
     
     return medicine_candidates
 
-# Function to verify a medicine name using Google Search with focus on Bangladeshi sources
+# Function to verify a medicine name against the local catalog (Google Search as fallback)
 def verify_medicine_with_search(medicine_candidate):
-    search_query = f"{medicine_candidate['name']} medicine Bangladesh MedEx Arogga"
+    tools = select_verification_tools(medicine_candidate['name'])
+    model = STAGE_MODELS["escalation"] if medicine_candidate.get('escalate') else stage_model("verification")
+    
+    # Coalesce with in-flight verifications of the same normalized name, tools and model
+    key = (normalize_name(medicine_candidate['name']), "catalog" if tools is catalog_tools else "search", model)
     
     try:
-        response = client.models.generate_content(
-            model=model_id,
+        response = verification_flight.do(
+            key,
+            verification_hedger.call,
+            get_client().models.generate_content,
+            model=model,
             contents=f"""
             I need to verify if a medicine named "{medicine_candidate['name']}" exists in Bangladesh.
-            Search for this medicine with focus on Bangladeshi pharmaceutical websites like MedEx or Arogga.
+            Use the lookup_medicine tool to check it against the Bangladeshi medicine catalog
+            (if it is not available, search Bangladeshi pharmaceutical websites like MedEx or Arogga).
             
             If you find a similar medicine with slightly different spelling, provide that corrected name.
             
-            Provide your response in this format:
+            Respond briefly, only in this format:
             - Corrected Name: [verified medicine name]
             - Confidence: [how confident you are this is the correct medicine, on scale 0-100]
-            - Source: [website where you found this information]
-            - Notes: [any relevant details about the medication or spelling correction]
             """,
-            config=GenerateContentConfig(
-                tools=[google_search_tool],
-                response_modalities=["TEXT"],
-            )
+            config={
+                "tools": tools,
+                "response_modalities": ["TEXT"],
+                "http_options": verification_hedger.http_options(),
+            }
         )
         
         return {
             "original": medicine_candidate['name'],
             "verification_result": response.text,
-            "dosage": medicine_candidate['dosage']
+            "dosage": medicine_candidate['dosage'],
+            "dosage_info": medicine_candidate['dosage_info'],
+            "sources": filter_and_rank_sources(extract_grounding_sources(response))
         }
     except Exception as e:
         print(f"Error verifying medicine {medicine_candidate['name']}: {e}")
         return {
             "original": medicine_candidate['name'],
             "verification_result": f"Error: {str(e)}",
-            "dosage": medicine_candidate['dosage']
+            "dosage": medicine_candidate['dosage'],
+            "dosage_info": medicine_candidate['dosage_info'],
+            "sources": []
         }
 
 # Function to extract the final verified medicine information
+@tracer.traced("final")
 def process_verification_results(verification_results):
     final_prompt = """
     You are one of the best medicine prescription readers in Bangladesh. Based on multiple verification attempts of medicines from a prescription, provide the final accurate list of medicines.
     
     For each medicine, I'll provide:
     1. The original prediction from the prescription
-    2. Verification results from Google searches focusing on Bangladeshi pharmaceutical sources
-    3. Dosage information if available
+    2. Verification results from the Bangladeshi medicine catalog (or Google searches on Bangladeshi pharmaceutical sources)
+    3. Dosage information if available (already parsed locally where possible)
     
     Your task is to determine the most accurate medicine name based on this information. Always prioritize matches from Bangladeshi websites like MedEx or Arogga.
     
@@ -179,7 +224,7 @@ def process_verification_results(verification_results):
     Important guidelines:
     - List only distinct medicines (remove duplicates)
     - Choose the most accurate name based on verification results
-    - Include dosage information when available
+    - Include dosage information when available: copy dosages marked "parsed" exactly, only interpret the ones marked "not parsed"
     - Extract any special instructions for taking the medicine
     """
     
@@ -188,32 +233,33 @@ def process_verification_results(verification_results):
     for i, result in enumerate(verification_results, 1):
         formatted_results += f"\nMedicine Candidate {i}:\n"
         formatted_results += f"- Original: {result['original']}\n"
-        formatted_results += f"- Dosage Info: {result['dosage']}\n"
+        formatted_results += f"- Dosage Info: {describe_dosage(result['dosage_info'])}\n"
         formatted_results += f"- Verification:\n{result['verification_result']}\n"
         formatted_results += "-" * 40 + "\n"
     
     final_prompt = final_prompt.replace("{VERIFICATION_RESULTS}", formatted_results)
     
-    # Get final analysis with Google search capability
-    response = client.models.generate_content(
-        model=model_id,
+    # Get final analysis with catalog lookup capability
+    response = get_client().models.generate_content(
+        model=stage_model("final"),
         contents=final_prompt,
-        config=GenerateContentConfig(
-            tools=[google_search_tool],
-            response_modalities=["TEXT"],
-            temperature=0.2,  # Lower temperature for more deterministic output
-        )
+        config={
+            "tools": catalog_tools,
+            "response_modalities": ["TEXT"],
+            "temperature": 0.2,  # Lower temperature for more deterministic output
+        }
     )
     
     return response.text
 
 # Main execution flow
-def main():
+@tracer.traced("prescription")
+def main(image):
     # Execute all interpretation passes concurrently
     print(f"Running 5 interpretation passes in parallel...")
     start_time = time.time()
     
-    all_interpretations = run_parallel_interpretations()
+    all_interpretations = run_parallel_interpretations(image)
     
     interpretation_time = time.time()
     print(f"All interpretation passes completed in {interpretation_time - start_time:.2f} seconds")
@@ -238,13 +284,49 @@ def main():
     unique_candidates = list(unique_medicines.values())
     print(f"Reduced to {len(unique_candidates)} unique medicine candidates")
     
-    # Verify each unique medicine candidate with Google Search
-    print("\nVerifying medicines with Google Search (this may take some time)...")
+    # Map every unique name with the tuned model first; its mappings are used as verification results
+    # and only the names it cannot map confidently are verified below
     verification_results = []
+    if TUNED_MODEL_ID:
+        try:
+            mapped = normalize_with_tuned_model(get_client(), TUNED_MODEL_ID, [c['name'] for c in unique_candidates], stats=cascade_stats)
+        except Exception as e:
+            print(f"Error normalizing with {TUNED_MODEL_ID}: {e}")
+            mapped = {}
+        for candidate in unique_candidates:
+            fields = mapped.get(candidate['name'])
+            if fields:
+                verification_results.append({
+                    "original": candidate['name'],
+                    "verification_result": f"- Corrected Name: {fields['brandName']} "
+                                           f"({fields.get('genericName', 'generic unknown')}, {fields.get('dosageType', 'form unknown')}) "
+                                           f"- mapped by the tuned model",
+                    "dosage": candidate['dosage'],
+                    "dosage_info": candidate['dosage_info'],
+                    "sources": []
+                })
+        cascade_stats.record("resolved_by_tuned_model", len(verification_results))
+        print(f"Tuned model mapped {len(verification_results)} of {len(unique_candidates)} unique medicine candidates")
+        unique_candidates = [c for c in unique_candidates if c['name'] not in mapped]
+    
+    # Mark low-confidence / disagreeing candidates for verification on the stronger model
+    if CASCADE_MODE:
+        cascade_stats.record("candidates", len(unique_candidates))
+        for candidate in unique_candidates:
+            passes = [c for c in medicine_candidates if c['name'].lower() == candidate['name'].lower()]
+            candidate['escalate'] = needs_escalation(passes, len(all_interpretations), ESCALATION_CONFIDENCE, ESCALATION_AGREEMENT)
+            if candidate['escalate']:
+                cascade_stats.record("escalated_verifications")
+    
+    # Verify each remaining medicine candidate against the catalog
+    print("\nVerifying medicines against the medicine catalog...")
     
     # Process verification in parallel
-    with concurrent.futures.ThreadPoolExecutor(max_workers=min(5, len(unique_candidates))) as executor:
-        future_to_medicine = {executor.submit(verify_medicine_with_search, med): med for med in unique_candidates}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(5, len(unique_candidates)))) as executor:
+        future_to_medicine = {
+            executor.submit(tracer.wrap(verify_medicine_with_search, "verify_medicine", medicine=med['name']), med): med
+            for med in unique_candidates
+        }
         
         for future in concurrent.futures.as_completed(future_to_medicine):
             medicine = future_to_medicine[future]
@@ -265,10 +347,30 @@ def main():
     end_time = time.time()
     print(f"Final analysis completed in {end_time - verification_time:.2f} seconds")
     print(f"Total processing time: {end_time - start_time:.2f} seconds")
+    print(f"Hedging - {interpretation_hedger.report()}")
+    print(f"Hedging - {verification_hedger.report()}")
+    print(f"Coalescing - {verification_flight.report()}")
+    if CASCADE_MODE:
+        print(f"Cascade - {cascade_stats.report()}")
     
     # Print final results
     print("\n=== FINAL EXTRACTED MEDICINES ===")
     print(final_result)
+    
+    # Print the grounded sources (only present when the Google Search fallback was used)
+    if any(result['sources'] for result in verification_results):
+        print("\n=== SOURCES ===")
+        for result in verification_results:
+            print(f"{result['original']}:")
+            print(format_sources(result['sources']))
 
 if __name__ == "__main__":
-    main()
+    import sys
+    
+    # python pharama_agent_exp1.py [image_path]; without a path the image is uploaded in Colab
+    if len(sys.argv) > 1:
+        file_content, mime_type = load_prescription("path", sys.argv[1])
+    else:
+        file_content, mime_type = load_prescription("colab")
+    main(load_image(file_content, mime_type))
+    tracer.export()
@@ -0,0 +1,38 @@
+import mimetypes
+
+# Environment adapters for getting a prescription image. Each returns (image bytes, mime type);
+# register new ones in IMAGE_SOURCES.
+
+
+# Function to read the prescription from the Colab upload widget
+def from_colab_upload():
+    from google.colab import files
+
+    print("Please upload the prescription image:")
+    uploaded = files.upload()
+
+    # Get the first uploaded file
+    file_name = list(uploaded.keys())[0]
+    return uploaded[file_name], mimetypes.guess_type(file_name)[0] or "image/jpeg"
+
+
+# Function to read the prescription from a file on disk
+def from_path(path):
+    with open(path, "rb") as f:
+        return f.read(), mimetypes.guess_type(path)[0] or "image/jpeg"
+
+
+# Function to use prescription bytes that are already in memory
+def from_bytes(data, mime_type="image/jpeg"):
+    return data, mime_type
+
+
+IMAGE_SOURCES = {
+    "colab": from_colab_upload,
+    "path": from_path,
+    "bytes": from_bytes,
+}
+
+
+def load_prescription(source, *args, **kwargs):
+    return IMAGE_SOURCES[source](*args, **kwargs)
@@ -0,0 +1,67 @@
+import asyncio
+import concurrent.futures
+import threading
+
+
+# Single-flight request coalescing: while a call for a key is in flight, other callers with the
+# same key wait for it and share its result (or exception) instead of issuing their own call.
+# Thread-pool callers use do(), asyncio callers use do_async(); both share the same in-flight table,
+# so a coroutine can join a call started by a thread and vice versa. Nothing is cached after the
+# call completes.
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.stats = {"calls": 0, "executed": 0, "coalesced": 0}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    # Returns (future, is_leader); the leader must run the call and complete the future
+    def _join(self, key):
+        with self._lock:
+            self.stats["calls"] += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.stats["coalesced"] += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self._in_flight[key] = future
+            self.stats["executed"] += 1
+            return future, True
+
+    def _complete(self, key, future, result=None, error=None):
+        with self._lock:
+            self._in_flight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, *args, **kwargs):
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._complete(key, future, error=e)
+            raise
+        self._complete(key, future, result)
+        return result
+
+    async def do_async(self, key, coro_fn, *args, **kwargs):
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await coro_fn(*args, **kwargs)
+        except BaseException as e:
+            self._complete(key, future, error=e)
+            raise
+        self._complete(key, future, result)
+        return result
+
+    # Function to format the coalescing counters for the run summary
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+        return f"{self.name}: {stats['calls']} requests, {stats['executed']} executed, {stats['coalesced']} coalesced"
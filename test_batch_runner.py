@@ -0,0 +1,94 @@
+from types import SimpleNamespace
+
+import pytest
+
+import batch_runner
+
+INTERPRETATION = "1. Napa: 90% 1+0+1\n2. Montair: 85% 0+0+1 after meal\n"
+
+
+class QuotaError(Exception):
+    code = 429
+    status = "RESOURCE_EXHAUSTED"
+
+
+# Fake google-genai client: interpretation prompts (with the image) get INTERPRETATION, verification
+# and final prompts get the name back; fail(contents) may raise to simulate API errors
+class FakeClient:
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.models = SimpleNamespace(generate_content=self.generate_content)
+
+    def generate_content(self, model, contents, config=None):
+        if self.fail:
+            self.fail(contents)
+        text = INTERPRETATION if isinstance(contents, list) else "Napa"
+        return SimpleNamespace(text=text, candidates=[])
+
+
+@pytest.fixture
+def agent(monkeypatch):
+    agent = batch_runner.load_agent()
+    monkeypatch.setattr(agent, "STREAMING_MODE", False)
+    return agent
+
+
+@pytest.fixture
+def state(tmp_path):
+    image = tmp_path / "rx.jpg"
+    image.write_bytes(b"\xff\xd8")
+    state_dir = str(tmp_path / "state")
+    conn = batch_runner.connect(state_dir)
+    batch_runner.enqueue(conn, [str(image)])
+    conn.close()
+    return state_dir, str(image)
+
+
+def run_worker(agent, monkeypatch, state_dir, client):
+    monkeypatch.setattr(agent, "get_client", lambda: client)
+    batch_runner.worker_main(state_dir, 0)
+    conn = batch_runner.connect(state_dir)
+    status = conn.execute("SELECT status FROM work").fetchone()[0]
+    stages = {stage for (stage,) in conn.execute("SELECT stage FROM stage_results")}
+    conn.close()
+    return status, stages
+
+
+def test_quota_error_saves_nothing(agent, monkeypatch, state):
+    def quota(contents):
+        raise QuotaError("429 RESOURCE_EXHAUSTED")
+
+    status, stages = run_worker(agent, monkeypatch, state[0], FakeClient(quota))
+    assert status == "pending"
+    assert stages == set()
+
+
+def test_failed_verification_is_not_checkpointed(agent, monkeypatch, state):
+    calls = {"interpretation": 0, "verification": 0}
+
+    # Both verifications of the first attempt fail; the retry resumes from the saved interpretation
+    def verification_down_once(contents):
+        if isinstance(contents, list):
+            calls["interpretation"] += 1
+        elif "interpretations of a medicine name" in contents:
+            calls["verification"] += 1
+            if calls["verification"] <= 2:
+                raise ConnectionError("verification unavailable")
+
+    status, stages = run_worker(agent, monkeypatch, state[0], FakeClient(verification_down_once))
+    assert status == "done"
+    assert stages == {"interpretation", "verification", "final"}
+    assert calls["interpretation"] == 5
+    assert calls["verification"] == 4
+
+
+def test_all_interpretation_passes_failing_fails_the_stage(agent, monkeypatch):
+    def interpretation_down(contents):
+        if isinstance(contents, list):
+            raise ConnectionError("interpretation unavailable")
+
+    monkeypatch.setattr(agent, "get_client", lambda: FakeClient(interpretation_down))
+    saved = []
+    with pytest.raises(agent.StageFailed):
+        agent.run_pipeline(agent.load_image(b"\xff\xd8"), on_stage_done=lambda stage, result: saved.append(stage))
+    assert saved == []
@@ -0,0 +1,70 @@
+from dosage_parser import describe_dosage, parse_dosage, select_dosage
+
+
+def test_pattern_with_duration_and_meal():
+    info = parse_dosage("1+0+1 x 7 days after meal")
+    assert info["understood"]
+    assert info["doses"] == [1, 0, 1]
+    assert info["times_per_day"] == 2
+    assert info["duration_days"] == 7
+    assert info["meal"] == "after"
+
+
+def test_abbreviation_with_strength():
+    info = parse_dosage("500mg BD")
+    assert info["understood"]
+    assert info["times_per_day"] == 2
+    assert info["strength"] == "500mg"
+
+
+def test_fractions():
+    assert parse_dosage("½+0+½")["doses"] == [0.5, 0, 0.5]
+    info = parse_dosage("1½+0+1")
+    assert info["understood"]
+    assert info["doses"] == [1.5, 0, 1]
+
+
+def test_malformed_dose_does_not_raise():
+    info = parse_dosage("½½+0+1")
+    assert not info["understood"]
+    assert info["raw"] == "½½+0+1"
+
+
+def test_parenthesized_duration_is_kept():
+    info = parse_dosage("1+1+1 (7 days)")
+    assert info["understood"]
+    assert info["duration_days"] == 7
+
+
+def test_unparsed_frequency_words_keep_raw_text():
+    info = parse_dosage("500mg 1 tab thrice daily")
+    assert not info["understood"]
+    assert describe_dosage(info) == "500mg 1 tab thrice daily (not parsed - interpret this)"
+
+
+def test_meal_without_frequency_is_not_understood():
+    info = parse_dosage("1 tab daily after meal")
+    assert not info["understood"]
+    assert "1 tab daily after meal" in describe_dosage(info)
+
+
+def test_leftover_tokens_are_not_dropped():
+    assert not parse_dosage("1+0+1 2 weeks then 0+0+1")["understood"]
+    assert not parse_dosage("BD x 5 days then OD")["understood"]
+
+
+def test_date_is_not_a_dose_pattern():
+    info = parse_dosage("12-05-2024")
+    assert info["pattern"] == ""
+    assert not info["understood"]
+
+
+def test_as_needed():
+    info = parse_dosage("SOS")
+    assert info["understood"]
+    assert info["as_needed"]
+
+
+def test_select_dosage_falls_back_to_raw_text():
+    candidates = [{"dosage": "1 tab daily after meal", "dosage_info": parse_dosage("1 tab daily after meal")}]
+    assert select_dosage(candidates)["raw"] == "1 tab daily after meal"
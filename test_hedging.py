@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pytest
+
+from hedging import HedgedCaller
+
+
+def test_fast_call_is_not_hedged():
+    caller = HedgedCaller("test", deadline=2.0, initial_hedge_delay=0.5)
+    assert caller.call(lambda x: x * 2, 21) == 42
+    assert caller.stats == {"calls": 1, "hedges_fired": 0, "hedges_won": 0, "deadline_exceeded": 0}
+
+
+def test_slow_primary_is_hedged_and_hedge_wins():
+    calls = []
+    lock = threading.Lock()
+
+    def first_call_slow():
+        with lock:
+            calls.append(None)
+            attempt = len(calls)
+        time.sleep(1.0 if attempt == 1 else 0.01)
+        return attempt
+
+    caller = HedgedCaller("test", deadline=2.0, initial_hedge_delay=0.1, max_hedge_rate=1.0)
+    assert caller.call(first_call_slow) == 2
+    assert caller.stats["hedges_fired"] == 1
+    assert caller.stats["hedges_won"] == 1
+
+
+def test_hedge_budget_is_capped():
+    caller = HedgedCaller("test", deadline=2.0, initial_hedge_delay=0.01, max_hedge_rate=0.5)
+    for _ in range(4):
+        caller.call(time.sleep, 0.05)
+    assert caller.stats["calls"] == 4
+    assert caller.stats["hedges_fired"] == 2
+
+
+def test_deadline_is_enforced_before_the_hedge_delay():
+    caller = HedgedCaller("test", deadline=0.3, initial_hedge_delay=1.0)
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        caller.call(time.sleep, 2.0)
+    assert time.monotonic() - start < 0.6
+    assert caller.stats["deadline_exceeded"] == 1
+    assert caller.stats["hedges_fired"] == 0
+
+
+def test_no_hedge_without_time_left_for_it():
+    caller = HedgedCaller("test", deadline=0.5, initial_hedge_delay=0.3, min_samples=1, max_hedge_rate=1.0)
+    caller.latencies.extend([0.4, 0.4, 0.4])  # a fresh call needs 0.4s, only ~0.1s would be left
+    with pytest.raises(TimeoutError):
+        caller.call(time.sleep, 1.0)
+    assert caller.stats["hedges_fired"] == 0
+
+
+def test_errors_are_raised():
+    def fail():
+        raise ValueError("boom")
+
+    caller = HedgedCaller("test", deadline=1.0, initial_hedge_delay=0.5)
+    with pytest.raises(ValueError):
+        caller.call(fail)
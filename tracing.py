@@ -0,0 +1,192 @@
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+# Enable with PRESCRIPTION_TRACE=1 (or tracer.enabled = True). When disabled, span() returns a
+# shared no-op object and wrap()/traced() hand back the original function, so the overhead is
+# a single attribute check.
+TRACE_ENABLED = os.environ.get("PRESCRIPTION_TRACE") == "1"
+TRACE_PATH = os.environ.get("PRESCRIPTION_TRACE_PATH", "prescription_trace.json")
+OTLP_ENDPOINT = os.environ.get("PRESCRIPTION_OTLP_ENDPOINT")  # e.g. "http://localhost:4318/v1/traces"
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    def __init__(self, tracer, name, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = f"{next(tracer._ids):016x}"
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.thread_id = None
+        self.thread_name = None
+        self.start_ns = None
+        self.end_ns = None
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        thread = threading.current_thread()
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self._token = _current_span.set(self)
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.perf_counter_ns()
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.attributes["error"] = repr(exc)
+        self.tracer._finish(self)
+        return False
+
+
+class Tracer:
+    def __init__(self, enabled=TRACE_ENABLED, service_name="pharma-agent"):
+        self.enabled = enabled
+        self.service_name = service_name
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # perf_counter gives precise durations; the epoch offset is needed for OTLP timestamps
+        self._epoch_offset_ns = time.time_ns() - time.perf_counter_ns()
+
+    def _finish(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    # Function to open a span as a child of the current span
+    def span(self, name, **attributes):
+        if not self.enabled:
+            return _NOOP_SPAN
+        parent = _current_span.get()
+        return Span(self, name, parent.span_id if parent else None, attributes)
+
+    # Decorator that wraps every call of the function in a span
+    def traced(self, name):
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # Function to carry the current span into a worker thread. Call it at submit time; with a
+    # name the call gets its own span, including how long it waited in the thread-pool queue.
+    def wrap(self, fn, name=None, **attributes):
+        if not self.enabled:
+            return fn
+        parent = _current_span.get()
+        submitted_ns = time.perf_counter_ns()
+
+        def run(*args, **kwargs):
+            token = _current_span.set(parent)
+            try:
+                if name is None:
+                    return fn(*args, **kwargs)
+                queue_ms = (time.perf_counter_ns() - submitted_ns) / 1e6
+                with self.span(name, queue_ms=round(queue_ms, 3), **attributes):
+                    return fn(*args, **kwargs)
+            finally:
+                _current_span.reset(token)
+        return run
+
+    # Function to write the finished spans as a Chrome trace (chrome://tracing, Perfetto)
+    def export_chrome_trace(self, path=TRACE_PATH):
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = []
+        for thread_id, thread_name in {(s.thread_id, s.thread_name) for s in spans}:
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id,
+                           "args": {"name": thread_name}})
+        for s in spans:
+            events.append({
+                "name": s.name,
+                "cat": "pipeline",
+                "ph": "X",
+                "ts": s.start_ns / 1000,
+                "dur": (s.end_ns - s.start_ns) / 1000,
+                "pid": pid,
+                "tid": s.thread_id,
+                "args": {"span_id": s.span_id, "parent_id": s.parent_id, **s.attributes},
+            })
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return path
+
+    # Function to send the finished spans to an OTLP/HTTP collector as JSON
+    def export_otlp(self, endpoint=OTLP_ENDPOINT, timeout=5.0):
+        import urllib.request
+
+        with self._lock:
+            spans = list(self.spans)
+        otlp_spans = []
+        for s in spans:
+            otlp_span = {
+                "traceId": self.trace_id,
+                "spanId": s.span_id,
+                "name": s.name,
+                "kind": 1,
+                "startTimeUnixNano": str(s.start_ns + self._epoch_offset_ns),
+                "endTimeUnixNano": str(s.end_ns + self._epoch_offset_ns),
+                "attributes": [
+                    {"key": key, "value": {"stringValue": str(value)}}
+                    for key, value in {**s.attributes, "thread.name": s.thread_name}.items()
+                ],
+            }
+            if s.parent_id:
+                otlp_span["parentSpanId"] = s.parent_id
+            otlp_spans.append(otlp_span)
+
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": otlp_spans}],
+        }]}
+        request = urllib.request.Request(
+            endpoint, data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status
+
+    # Function to export to whichever destinations are configured
+    def export(self):
+        if not self.enabled:
+            return
+        print(f"Trace written to {self.export_chrome_trace()}")
+        if OTLP_ENDPOINT:
+            try:
+                self.export_otlp()
+            except Exception as e:
+                print(f"Error exporting trace to {OTLP_ENDPOINT}: {e}")
+
+
+# Process-wide tracer shared by the agents and helper modules
+tracer = Tracer()